@@ -21,8 +21,15 @@ Example usage on ESP8266:
 """
 
 from micropython import const
+from array import array
 import time
 
+try:
+    # native data transport (the sdspi C module), token waits and DMA blocks
+    import sdspi
+except ImportError:
+    sdspi = None
+
 
 _CMD_TIMEOUT = const(100)
 
@@ -38,14 +45,36 @@ _TOKEN_STOP_TRAN = const(0xFD)
 _TOKEN_DATA = const(0xFE)
 
 
+if sdspi is not None:
+    _crc16 = sdspi.crc16
+else:
+    _CRC16_TABLE = array("H", bytearray(512))
+    for _i in range(256):
+        _c = _i << 8
+        for _j in range(8):
+            _c = ((_c << 1) ^ 0x1021) if _c & 0x8000 else _c << 1
+        _CRC16_TABLE[_i] = _c & 0xFFFF
+
+    def _crc16(data):
+        # CRC16-CCITT the card appends to every data block, a table lookup per byte
+        crc = 0
+        table = _CRC16_TABLE
+        for b in data:
+            crc = ((crc << 8) & 0xFFFF) ^ table[(crc >> 8) ^ b]
+        return crc
+
+
 class SDCard:
-    def __init__(self, spi, cs, baudrate=1320000):
+    def __init__(self, spi, cs, baudrate=1320000, spi_id=None):
         self.spi = spi
         self.cs = cs
+        # hardware SPI number for the native transport, None keeps it in Python
+        self.native = spi_id if sdspi is not None else None
 
         self.cmdbuf = bytearray(6)
         self.dummybuf = bytearray(512)
         self.tokenbuf = bytearray(1)
+        self.crcbuf = bytearray(2)
         for i in range(512):
             self.dummybuf[i] = 0xFF
         self.dummybuf_memoryview = memoryview(self.dummybuf)
@@ -54,6 +83,7 @@ class SDCard:
         self.init_card(baudrate)
 
     def init_spi(self, baudrate):
+        self.baudrate = baudrate
         try:
             master = self.spi.MASTER
         except AttributeError:
@@ -202,12 +232,39 @@ class SDCard:
         self.spi.write_readinto(mv, buf)
 
         # read checksum
-        self.spi.write(b"\xff")
-        self.spi.write(b"\xff")
+        self.spi.readinto(self.crcbuf, 0xFF)
 
         self.cs(1)
         self.spi.write(b"\xff")
 
+    def cid(self):
+        # CMD10: card identification, response R2 like CMD9
+        if self.cmd(10, 0, 0, 0, False) != 0:
+            raise OSError(5)  # EIO
+        cid = bytearray(16)
+        self.readinto(cid)
+        return cid
+
+    def read_checked(self, block_num, buf):
+        # read one block and check it against the CRC the card sends with it,
+        # False on any error, for testing the link at a new clock rate
+        self.spi.write(b"\xff")
+        if self.cmd(17, block_num * self.cdv, 0, release=False) != 0:
+            self.cs(1)
+            return False
+        try:
+            if self.native is not None:
+                try:
+                    sdspi.read(self.native, buf, True)
+                finally:
+                    self.cs(1)
+                    self.spi.write(b"\xff")
+                return True
+            self.readinto(buf)
+        except OSError:
+            return False
+        return _crc16(buf) == (self.crcbuf[0] << 8 | self.crcbuf[1])
+
     def write(self, token, buf):
         self.cs(0)
 
@@ -248,7 +305,22 @@ class SDCard:
 
         nblocks = len(buf) // 512
         assert nblocks and not len(buf) % 512, "Buffer length is invalid"
-        if nblocks == 1:
+        if self.native is not None:
+            # CMD17/CMD18, then all the data blocks in one native call
+            if self.cmd(17 if nblocks == 1 else 18, block_num * self.cdv, 0, release=False) != 0:
+                # release the card
+                self.cs(1)
+                raise OSError(5)  # EIO
+            try:
+                sdspi.read(self.native, buf)
+            finally:
+                self.cs(1)
+                self.spi.write(b"\xff")
+                # end a multi-block read after an error too, or the card keeps sending
+                stopped = nblocks == 1 or self.cmd(12, 0, 0xFF, skip1=True) == 0
+            if not stopped:
+                raise OSError(5)  # EIO
+        elif nblocks == 1:
             # CMD17: set read address for single block
             if self.cmd(17, block_num * self.cdv, 0, release=False) != 0:
                 # release the card
@@ -279,7 +351,21 @@ class SDCard:
 
         nblocks, err = divmod(len(buf), 512)
         assert nblocks and not err, "Buffer length is invalid"
-        if nblocks == 1:
+        if self.native is not None:
+            # CMD24/CMD25, then all the data blocks in one native call
+            if self.cmd(24 if nblocks == 1 else 25, block_num * self.cdv, 0) != 0:
+                raise OSError(5)  # EIO
+            self.cs(0)
+            try:
+                sdspi.write(self.native, _TOKEN_DATA if nblocks == 1 else _TOKEN_CMD25, buf)
+            finally:
+                self.cs(1)
+                self.spi.write(b"\xff")
+                # end a multi-block write after an error too, or the card
+                # stays in receive mode and rejects every later command
+                if nblocks > 1:
+                    self.write_token(_TOKEN_STOP_TRAN)
+        elif nblocks == 1:
             # CMD24: set write address for single block
             if self.cmd(24, block_num * self.cdv, 0) != 0:
                 raise OSError(5)  # EIO
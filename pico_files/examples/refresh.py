@@ -7,13 +7,12 @@ terminal.dryBuffer()
 terminal.wr("\x1b[?25l")  # hide cursor
 terminal.stopRefresh()
 i=0
-temp =bytearray(1)
 
 def processKey():
-    # Read a key from the keyboard
-    if keyboard.readinto(temp):
-        key = temp[0]
-        if key == ord('E') or key == ord('e'):
+    # Read the keyboard once per frame, then look at what was pressed
+    keys = keyboard.keyState
+    for i in range(keyboard.poll_state()):
+        if keys.pressed(i) and (keys.key(i) == ord('E') or keys.key(i) == ord('e')):
             return True
     return False    
 
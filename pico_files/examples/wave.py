@@ -198,10 +198,10 @@ def draw_wave(amplitude, freq, phase, cam_dist, pitch, yaw):
         display.fill_rect(x - half_size, y - half_size, size, size, color)
 
 def processKey():
-    # Read a key from the keyboard
-    if keyboard.readinto(temp):
-        key = temp[0]
-        if key == ord('E') or key == ord('e'):
+    # Read the keyboard once per frame, then look at what was pressed
+    keys = keyboard.keyState
+    for i in range(keyboard.poll_state()):
+        if keys.pressed(i) and (keys.key(i) == ord('E') or keys.key(i) == ord('e')):
             return True
     return False    
 
@@ -230,7 +230,6 @@ for i in range(16):
     color_lut[i] = swapped
 
 display.setLUT(color_lut)
-temp =bytearray(30)
 amp = 0.5  # Amplitude of the wave
 freq = 0.5  # Frequency of the wave
 phase = 0.0  # Phase shift of the wave
@@ -244,8 +243,17 @@ while(True):
         phase -= 2 * math.pi  # Reset phase to keep it within bounds
     if processKey():
         break
+    # Held arrow keys turn the camera, several at once work too
+    if keyboard.keyState.down(0xB4):
+        yaw -= 0.05
+    if keyboard.keyState.down(0xB7):
+        yaw += 0.05
+    if keyboard.keyState.down(0xB5):
+        pitch -= 0.05
+    if keyboard.keyState.down(0xB6):
+        pitch += 0.05
     draw_wave(amp, freq, phase, cam_dist, pitch, yaw)
-    terminal.wr("\x1b[40;1HPress \'E\' to break...")
+    terminal.wr("\x1b[40;1HArrows turn, press \'E\' to break...")
     display.show(0)  # show in manual refresh mode
     #time.sleep(0.03)
 
@@ -258,7 +266,7 @@ while(True):
 #del coords, grid_x, grid_y, grid_r
 #del proj_x, proj_y, proj_size, proj_depth, proj_color, proj_visible
 #del draw_order, sort_keys, sin_lut
-#del temp, amp, freq, phase, cam_dist, pitch, yaw
+#del amp, freq, phase, cam_dist, pitch, yaw
 #del color_lut,gamma
 gc.collect()  # Run garbage collector to free up memory
 terminal.recoverRefresh()
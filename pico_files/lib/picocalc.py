@@ -1,13 +1,14 @@
 import framebuf
 import picocalcdisplay
+import vtterminal
 from micropython import const
 import machine
 from machine import Pin, I2C, PWM, SPI, RTC
-from collections import deque
 import time, utime
 import sdcard
 import uos, os
 import array
+import _thread
 
 import network, socket
 
@@ -39,11 +40,48 @@ _REG_GIO = const(0x0F) # gpio value
 _REG_GIC = const(0x10) # gpio interrupt config
 _REG_GIN = const(0x11) # gpio interrupt status
 _KEY_COUNT_MASK = const(0x1F)
+_KEY_FIFO_SIZE = const(31)
+_I2C_SAFE_FREQ = const(10000)
+_I2C_FREQS = (400000, 200000, 100000, 50000, 20000)
+_I2C_RETRIES = const(5)
+_BATTERY_TTL = const(10000) # ms the battery level is reused for
+_RTC_TTL = const(500) # ms a time read from the RTC is reused for
+_CTRL_C = const(0x03)
+_READ_IDLE = const(100) # ms without a readinto() before Ctrl+C interrupts instead of being typed
+# SPI clocks tried for the SD card, 25 MHz is the most SPI mode allows without switching to high speed
+_SD_CLOCKS = (4000000, 8000000, 12500000, 16000000, 20000000, 25000000)
 _WRITE_MASK = const(1 << 7)
 _StateIdle = const(0)
 _StatePress = const(1)
 _StateLongPress = const(2)
 _StateRelease = const(3)
+_KEY_PAGE_UP = const(0xD6)
+_KEY_PAGE_DOWN = const(0xD7)
+_SCROLLBACK_PAGE = const(36) # lines per Shift+PgUp/PgDn step
+_KEY_F1 = const(0x81)
+_KEY_F8 = const(0x88)
+_MOD_SHIFT = const(1)
+_MOD_ALT = const(2)
+_MOD_CTRL = const(4)
+_MOD_BITS = b'\x02\x01\x01\x00\x04' # modifier bit of keys 0xa1 (alt) .. 0xa5 (ctrl)
+_MOD_NAMES = {"shift": _MOD_SHIFT, "alt": _MOD_ALT, "ctrl": _MOD_CTRL}
+_KEYMAP_SIZE = const(8 << 8) # every key code under every modifier combination
+_ESCAPES = {"e": 0x1b, "r": 0x0d, "n": 0x0a, "t": 0x09, "s": 0x20}
+# the built-in layout, a keymap file is read after it and overrides single entries
+_KEYMAP = """
+0x0A  *  \\r
+0x08  *  \\x7f
+0xB1  *  \\e\\e
+0xB4  *  \\e[{p}D
+0xB5  *  \\e[{p}A
+0xB6  *  \\e[{p}B
+0xB7  *  \\e[{p}C
+0xD2  *  \\e[H
+0xD5  *  \\e[F
+0xD4  *  \\e[3{m}~
+0xD6  *  \\e[5{m}~
+0xD7  *  \\e[6{m}~
+"""
 
 '''
 import uctypes
@@ -102,8 +140,19 @@ class PicoDisplay(framebuf.FrameBuffer):
             buffer = bytearray(self.width * self.height//8)
 
 
+        self.color_type = color_type
+        self.buffer = buffer
         super().__init__(buffer, self.width, self.height, color_type)
         picocalcdisplay.init(buffer,color_type,not self.manual_refresh)
+        if color_type == framebuf.GS2_HMSB or color_type == framebuf.MONO_HMSB:
+            self.grayLUT()
+
+    def grayLUT(self):
+        #black..white ramp for the 2 and 4 level formats, the terminal maps its colors onto it
+        lut = self.getLUT()
+        levels = (0x0000, 0xFFFF) if self.color_type == framebuf.MONO_HMSB else (0x0000, 0x8A52, 0x75AD, 0xFFFF)
+        for i, v in enumerate(levels):
+            lut[i] = v
         
     def setManual(self, toggle):
         self.manual_refresh = toggle
@@ -144,6 +193,7 @@ class PicoDisplay(framebuf.FrameBuffer):
         picocalcdisplay.drawTxt6x8(c,x0,y0,color)
 
     def show(self,core=1):
+        vtterminal.flush() #rasterize pending terminal cells before scanout
         if self.manual_refresh:
             return
         picocalcdisplay.update(core)
@@ -151,46 +201,474 @@ class PicoDisplay(framebuf.FrameBuffer):
     def isScreenUpdateDone(self):
         return picocalcdisplay.isScreenUpdateDone()
 
+class ByteRing:
+    #preallocated byte FIFO for terminal input. A write that does not fit is dropped
+    #whole (an escape sequence is never cut) and counted, highWater is the fullest it got
+    def __init__(self, size=64):
+        self.buf = bytearray(size)
+        self.mv = memoryview(self.buf)
+        self.size = size
+        self.head = 0
+        self.count = 0
+        self.dropped = 0
+        self.highWater = 0
+
+    def __len__(self):
+        return self.count
+
+    def clear(self):
+        self.head = 0
+        self.count = 0
+
+    def write(self, data, n=-1, start=0):
+        #n bytes of data from start (all of it by default), returns how many were taken
+        if n < 0:
+            n = len(data) - start
+        if n > self.size - self.count:
+            self.dropped += n
+            return 0
+        tail = self.head + self.count
+        for i in range(start, start + n):
+            if tail >= self.size:
+                tail -= self.size
+            self.buf[tail] = data[i]
+            tail += 1
+        self.count += n
+        if self.count > self.highWater:
+            self.highWater = self.count
+        return n
+
+    extend = write
+
+    def append(self, b):
+        if self.count == self.size:
+            self.dropped += 1
+            return
+        tail = self.head + self.count
+        self.buf[tail - self.size if tail >= self.size else tail] = b
+        self.count += 1
+        if self.count > self.highWater:
+            self.highWater = self.count
+
+    def popleft(self):
+        if not self.count:
+            raise IndexError("empty")
+        b = self.buf[self.head]
+        self.head = (self.head + 1) % self.size
+        self.count -= 1
+        return b
+
+    def readinto(self, buf):
+        #as much as fits into buf, copied in at most two slices
+        n = min(len(buf), self.count)
+        first = min(n, self.size - self.head)
+        buf[0:first] = self.mv[self.head:self.head + first]
+        if n > first:
+            buf[first:n] = self.mv[0:n - first]
+        self.head = (self.head + n) % self.size
+        self.count -= n
+        return n
+
+    def stats(self, reset=False):
+        #(dropped bytes, high-water mark) to size the ring from
+        result = (self.dropped, self.highWater)
+        if reset:
+            self.dropped = 0
+            self.highWater = self.count
+        return result
+
+class Keymap:
+    #what each key sends, for every key code under every Shift/Alt/Ctrl combination,
+    #packed into one buffer so a keypress is a lookup that allocates nothing: entry
+    #mods<<8|key is data[index[i]:index[i+1]]. Keys the keymap does not name send
+    #their own code, Ctrl masks it to a control character and Alt prefixes ESC.
+    #
+    #A keymap file has one "key modifiers sequence" line per entry, # starts a comment:
+    #  key        0xB4, 180 or a single character
+    #  modifiers  - (none), * (all eight), or names joined by +, like shift+ctrl
+    #  sequence   \e \r \n \t \s (space) \\ and \xNN escapes, {m} is the xterm
+    #             modifier parameter (;2 for shift ... ;8), {p} the same after a 1.
+    #             An empty sequence makes the key send nothing
+    def __init__(self, filename=None):
+        entries = {}
+        self.parse(_KEYMAP.split("\n"), entries)
+        if filename:
+            with open(filename) as f:
+                self.parse(f, entries)
+        self.data = bytearray()
+        self.index = array.array('H', range(_KEYMAP_SIZE + 1))
+        for i in range(_KEYMAP_SIZE):
+            self.index[i] = len(self.data)
+            seq = entries.get(i)
+            if seq is not None:
+                self.data.extend(seq)
+                continue
+            key = i & 0xFF
+            if (i >> 8) & _MOD_ALT:
+                if key != ord(' ') and key != ord(',') and key != ord('.'):
+                    self.data.append(0x1b)#to match the vt100 terminal style
+                    self.data.append(key)
+            elif (i >> 8) & _MOD_CTRL:
+                self.data.append(key & 0x1F)
+            else:
+                self.data.append(key)
+        self.index[_KEYMAP_SIZE] = len(self.data)
+
+    def parse(self, lines, entries):
+        for n, line in enumerate(lines):
+            line = line.strip()
+            if not line or line[0] == '#':
+                continue
+            fields = line.split(None, 2)
+            if len(fields) < 2:
+                raise ValueError("keymap line {}: {}".format(n + 1, line))
+            key = ord(fields[0]) if len(fields[0]) == 1 else int(fields[0], 0)
+            if fields[1] == '*':
+                combos = range(8)
+            elif fields[1] == '-':
+                combos = (0,)
+            else:
+                mods = 0
+                for name in fields[1].lower().split('+'):
+                    if name not in _MOD_NAMES:
+                        raise ValueError("keymap line {}: unknown modifier {}".format(n + 1, name))
+                    mods |= _MOD_NAMES[name]
+                combos = (mods,)
+            seq = fields[2] if len(fields) > 2 else ""
+            for mods in combos:
+                m = ";{}".format(mods + 1) if mods else ""
+                entries[mods << 8 | key & 0xFF] = _unescape(seq.replace("{m}", m).replace("{p}", "1" + m if mods else ""))
+
+    def lookup(self, key, mods=0):
+        i = mods << 8 | key
+        return bytes(self.data[self.index[i]:self.index[i + 1]])
+
+    def byte(self, key, mods=0):
+        #the single byte a key sends, -1 for none or a sequence
+        i = mods << 8 | key
+        start = self.index[i]
+        return self.data[start] if self.index[i + 1] - start == 1 else -1
+
+    def send(self, ring, key, mods):
+        i = mods << 8 | key
+        start = self.index[i]
+        n = self.index[i + 1] - start
+        if n:
+            ring.write(self.data, n, start)
+
+def _unescape(text):
+    out = bytearray()
+    i = 0
+    while i < len(text):
+        c = text[i]
+        i += 1
+        if c != '\\' or i == len(text):
+            out.extend(c.encode())
+        elif text[i] == 'x':
+            out.append(int(text[i + 1:i + 3], 16))
+            i += 3
+        else:
+            out.append(_ESCAPES.get(text[i], ord(text[i])))
+            i += 1
+    return bytes(out)
+
+class KeyState:
+    #which keys are held, as a bitmap of key codes, and the press/release events
+    #with their ticks_ms. Events collect in a ring (the oldest is overwritten and
+    #counted in lost) until latch() copies them to key()/state()/time(), which
+    #stay put while the next ones arrive, so reading them allocates nothing
+    def __init__(self, size=32):
+        self.held = bytearray(32)
+        self.size = size
+        self.ringKeys = bytearray(size)
+        self.ringStates = bytearray(size)
+        self.ringTimes = array.array('i', bytearray(4 * size))
+        self.head = 0
+        self.count = 0
+        self.lost = 0
+        self.keys = bytearray(size)
+        self.states = bytearray(size)
+        self.times = array.array('i', bytearray(4 * size))
+
+    def down(self, key):
+        return self.held[key >> 3] >> (key & 7) & 1
+
+    def record(self, state, key):
+        if state == _StateRelease:
+            self.held[key >> 3] &= ~(1 << (key & 7))
+        else:
+            self.held[key >> 3] |= 1 << (key & 7)
+        i = self.head + self.count
+        if i >= self.size:
+            i -= self.size
+        if self.count == self.size:
+            self.head = self.head + 1 if self.head + 1 < self.size else 0
+            self.lost += 1
+        else:
+            self.count += 1
+        self.ringKeys[i] = key
+        self.ringStates[i] = state
+        self.ringTimes[i] = time.ticks_ms()
+
+    def latch(self):
+        #move the pending events to key()/state()/time(), returns how many
+        n = self.count
+        for j in range(n):
+            i = self.head + j
+            if i >= self.size:
+                i -= self.size
+            self.keys[j] = self.ringKeys[i]
+            self.states[j] = self.ringStates[i]
+            self.times[j] = self.ringTimes[i]
+        self.head = 0
+        self.count = 0
+        return n
+
+    def key(self, i):
+        return self.keys[i]
+
+    def state(self, i):
+        #1 press, 2 long press (auto-repeat), 3 release
+        return self.states[i]
+
+    def pressed(self, i):
+        return self.states[i] != _StateRelease
+
+    def time(self, i):
+        return self.times[i]
+
+    def clear(self):
+        for i in range(32):
+            self.held[i] = 0
+        self.count = 0
+
+class I2CBus:
+    #owner of one I2C controller, shared by the keyboard, the RTC and scan() so
+    #they agree on the clock. Transactions are serialized by a lock: the other
+    #core waits its turn, while a timer callback that lands in the middle of a
+    #transaction on this thread runs nested rather than deadlocking. A failed
+    #transaction is retried a bounded number of times, and transactions, retries
+    #and errors are counted per device address
+    def __init__(self, id=1, scl=7, sda=6, freq=_I2C_SAFE_FREQ, retries=_I2C_RETRIES):
+        self.id = id
+        self.scl = scl
+        self.sda = sda
+        self.retries = retries
+        self.lock = _thread.allocate_lock()
+        self.owner = None
+        self.depth = 0
+        self.counters = {} # address -> [transactions, retries, errors]
+        self.cache = {} # key -> [expiry ticks, value]
+        self.i2c = None
+        self.setFreq(freq)
+
+    def setFreq(self, freq):
+        with self:
+            self.freq = freq
+            self.i2c = I2C(self.id, scl=Pin(self.scl), sda=Pin(self.sda), freq=freq)
+
+    def __enter__(self):
+        #hold the bus for a sequence of transactions, the raw I2C object is returned
+        ident = _thread.get_ident()
+        if self.owner != ident:
+            self.lock.acquire()
+            self.owner = ident
+        self.depth += 1
+        return self.i2c
+
+    def __exit__(self, exc_type, exc, tb):
+        self.depth -= 1
+        if not self.depth:
+            self.owner = None
+            self.lock.release()
+
+    def busy(self):
+        #True inside a callback that interrupted a transaction on this thread
+        return self.owner == _thread.get_ident()
+
+    def _transfer(self, op, address, reg, buf):
+        counter = self.counters.get(address)
+        if counter is None:
+            counter = self.counters[address] = [0, 0, 0]
+        with self:
+            attempt = 0
+            while True:
+                counter[0] += 1
+                try:
+                    if op == 0:
+                        self.i2c.readfrom_mem_into(address, reg, buf)
+                    elif op == 1:
+                        self.i2c.writeto_mem(address, reg, buf)
+                    elif op == 2:
+                        self.i2c.writeto(address, buf)
+                    else:
+                        self.i2c.readfrom_into(address, buf)
+                    return buf
+                except OSError:
+                    if attempt == self.retries:
+                        counter[2] += 1
+                        raise
+                attempt += 1
+                counter[1] += 1
+                time.sleep_ms(1)
+
+    def readinto(self, address, reg, buf):
+        return self._transfer(0, address, reg, buf)
+
+    def writeto_mem(self, address, reg, buf):
+        self._transfer(1, address, reg, buf)
+
+    def writeto(self, address, buf):
+        self._transfer(2, address, None, buf)
+
+    def readfrom_into(self, address, buf):
+        return self._transfer(3, address, None, buf)
+
+    def scan(self):
+        with self as i2c:
+            return i2c.scan()
+
+    def cached(self, key, ttl, read):
+        #read() at most every ttl ms. The last value stands in when the bus is
+        #busy under a callback or the read fails
+        entry = self.cache.get(key)
+        now = time.ticks_ms()
+        if entry is not None and (time.ticks_diff(entry[0], now) > 0 or self.busy()):
+            return entry[1]
+        try:
+            value = read()
+        except OSError:
+            if entry is None:
+                raise
+            return entry[1]
+        self.cache[key] = [time.ticks_add(now, ttl), value]
+        return value
+
+    def invalidate(self, key):
+        self.cache.pop(key, None)
+
+    def stats(self, reset=False):
+        #{address: (transactions, retries, errors)}
+        result = {}
+        for address, counter in self.counters.items():
+            result[address] = tuple(counter)
+            if reset:
+                counter[0] = counter[1] = counter[2] = 0
+        return result
+
+_buses = {}
+
+def i2cBus(id=1, scl=7, sda=6):
+    #the shared bus for controller id, created on first use
+    bus = _buses.get(id)
+    if bus is None:
+        bus = _buses[id] = I2CBus(id, scl, sda)
+    return bus
+
 class PicoKeyboard:
-    def __init__(self,sclPin=7,sdaPin=6,address=0x1f):
-        self.hardwarekeyBuf = deque((),30)
-        self.i2c = I2C(1,scl=Pin(sclPin),sda=Pin(sdaPin),freq=10000)
-        #self.i2c.scan()
+    def __init__(self,sclPin=7,sdaPin=6,address=0x1f,bufSize=64,freq=None,keymap="/keymap.txt",eventSize=32):
+        self.hardwarekeyBuf = ByteRing(bufSize)
+        self.pendingKeys = ByteRing(2 * bufSize) # (mods, key) pairs drained but not yet sent
+        self.pendingKey = bytearray(2)
+        self.loadKeymap(keymap)
+        self.bus = i2cBus(1, sclPin, sdaPin)
+        #self.bus.scan()
         self.ignor = True
         self.address = address
         self.temp=bytearray(2)
+        self.transactions = 0
+        self.events = 0
         self.reset()
-        self.isShift = False
-        self.isCtrl = False
-        self.isAlt = False
+        if freq is None:
+            self.negotiateFreq()
+        else:
+            self.setFreq(freq)
+        self.mods = 0 # _MOD_SHIFT | _MOD_ALT | _MOD_CTRL held
+        self.keyState = KeyState(eventSize)
+        self.scanPeriod = 0 # ms between background scans, 0 when stopped
+        self.scanTimer = None
+        self.lastScan = 0
+        self.lastRead = 0
+        self.lastPoll = 0
+        self.viewingHistory = False
+
+    def loadKeymap(self, filename=None):
+        #a missing file leaves the built-in layout, so does a broken one, the console must still work
+        try:
+            self.keymap = Keymap(filename)
+        except OSError:
+            self.keymap = Keymap()
+        except ValueError as e:
+            print(f"{Fore.YELLOW}Ignoring {filename}: {e}")
+            self.keymap = Keymap()
     
     def ignor_mod(self):
         self.ignor = True
 
     def write_cmd(self,cmd):
-        self.i2c.writeto(self.address,bytearray([cmd]))
+        self.bus.writeto(self.address,bytearray([cmd]))
+
+    @property
+    def freq(self):
+        return self.bus.freq
+
+    def setFreq(self, freq):
+        self.bus.setFreq(freq)
+
+    def negotiateFreq(self, candidates=_I2C_FREQS, trials=16):
+        #pick the fastest bus clock at which the keyboard answers every probe
+        #exactly as it does at the safe clock, the STM32 firmware and the bus
+        #pull-ups differ between boards so this is measured, not assumed
+        with self.bus:
+            self.setFreq(_I2C_SAFE_FREQ)
+            version = bytes(self.read_reg16(_REG_VER))
+            backlight = bytes(self.read_reg16(_REG_BKL))
+            for freq in candidates:
+                if freq <= _I2C_SAFE_FREQ:
+                    break
+                self.setFreq(freq)
+                #raw reads, a retry would hide the errors being probed for
+                i2c = self.bus.i2c
+                try:
+                    for i in range(trials):
+                        i2c.readfrom_mem_into(self.address, _REG_VER, self.temp)
+                        if self.temp != version:
+                            break
+                        i2c.readfrom_mem_into(self.address, _REG_BKL, self.temp)
+                        if self.temp != backlight:
+                            break
+                    else:
+                        return freq
+                except OSError:
+                    pass
+            self.setFreq(_I2C_SAFE_FREQ)
+        return self.freq
+
+    def keyStats(self, reset=False):
+        #(I2C transactions, key events, transactions per key event)
+        result = (self.transactions, self.events, self.transactions / self.events if self.events else 0)
+        if reset:
+            self.transactions = 0
+            self.events = 0
+        return result
 
     def read_reg16(self, reg):
-        while True:
-            self.temp[0] = reg
-            try:
-                self.i2c.readfrom_mem_into(self.address, reg, self.temp)
-                return self.temp
-            except:
-                pass
+        #raises OSError once the bus has given up retrying
+        self.temp[0] = reg
+        self.transactions += 1
+        return self.bus.readinto(self.address, reg, self.temp)
     
     def read_reg8(self,reg):
-        self.i2c.writeto(self.address, bytes(reg)) 
-        #self.temp[0]=reg
-        #self.i2c.writeto(self.address,self.temp[0:1])
-        return self.i2c.readfrom(self.address, 1)[0]
-        #self.i2c.readfrom_into(self.address,memoryview(self.temp)[0:1])
-        #return self.temp
+        with self.bus:
+            self.bus.writeto(self.address, bytes(reg)) 
+            #self.temp[0]=reg
+            #self.bus.writeto(self.address,self.temp[0:1])
+            return self.bus.readfrom_into(self.address, self.temp[0:1])[0]
     
     def write_reg(self,reg,value):
         self.temp[0]=reg| _WRITE_MASK
         self.temp[1]=value
-        self.i2c.writeto(self.address,self.temp)
+        self.bus.writeto(self.address,self.temp)
 
     def enable_report_mods(self):
         currentCFG = self.read_reg8(_REG_CFG)
@@ -221,10 +699,9 @@ class PicoKeyboard:
         return (buf[0] & _KEY_COUNT_MASK)
 
     def keyEvent(self):
-        if (self.keyCount() == 0):
+        buf = self.read_reg16(_REG_FIF)
+        if buf[0] == _StateIdle:
             return None
-        else:
-            buf = self.read_reg16(_REG_FIF)
         return buf
     
     def backlight(self):
@@ -240,114 +717,424 @@ class PicoKeyboard:
         self.write_reg(_REG_BK2,value)
 
     def battery(self):
+        #the level moves slowly, so the header timer is answered from the cache
+        return self.bus.cached(self.address << 8 | _REG_BAT, _BATTERY_TTL, self._battery)
+
+    def _battery(self):
         return self.read_reg16(_REG_BAT)[1]
     
+    def drain(self, translate=True, interrupt=False):
+        #drain the FIFO directly, the firmware answers an empty FIFO with an
+        #idle event, so a batch of n keys costs n+1 transactions and an idle
+        #poll costs one, instead of a count read plus two reads per key.
+        #Every event updates keyState, translate also queues the presses for
+        #sendKeys(). With interrupt a Ctrl+C raises KeyboardInterrupt instead
+        for i in range(_KEY_FIFO_SIZE):
+            try:
+                keyGot = self.read_reg16(_REG_FIF)
+            except OSError:
+                break #counted by the bus, the keys wait for the next poll
+            state = keyGot[0]
+            if state == _StateIdle:
+                break
+            key = keyGot[1]
+            self.events += 1
+            self.keyState.record(state, key)
+            bit = _MOD_BITS[key - 0xa1] if key >= 0xa1 and key <= 0xa5 else 0
+            if state == _StatePress or state == _StateLongPress:
+                if bit:
+                    self.mods |= bit
+                elif interrupt and self.keymap.byte(key, self.mods) == _CTRL_C:
+                    vtterminal.interrupt()
+                elif translate:
+                    self.pendingKey[0] = self.mods
+                    self.pendingKey[1] = key
+                    self.pendingKeys.write(self.pendingKey)
+            elif bit:
+                self.mods &= ~bit
+
+    def sendKeys(self):
+        #translate the queued presses into hardwarekeyBuf. Only the thread that reads
+        #input calls this, never the background scanner: paging the scrollback and
+        #switching consoles draw on the terminal, which core0 may be writing to
+        pending = self.pendingKeys
+        while len(pending) >= 2:
+            mods = pending.popleft()
+            self.press(pending.popleft(), mods)
+
+    def press(self, key, mods):
+        paging = mods == _MOD_SHIFT and (key == _KEY_PAGE_UP or key == _KEY_PAGE_DOWN)
+        if self.viewingHistory and not paging:
+            #any other key goes back to the live screen
+            self.viewingHistory = False
+            vtterminal.scrollView(-vtterminal.scrollView(0))
+        if paging:
+            #shift pages the terminal scrollback
+            lines = _SCROLLBACK_PAGE if key == _KEY_PAGE_UP else -_SCROLLBACK_PAGE
+            self.viewingHistory = vtterminal.scrollView(lines) != 0
+        elif mods == _MOD_ALT and key >= _KEY_F1 and key <= _KEY_F8:
+            #Alt+F1..F8 shows virtual console 0..7
+            try:
+                vtterminal.showConsole(key - _KEY_F1)
+            except ValueError:
+                pass
+        else:
+            self.keymap.send(self.hardwarekeyBuf, key, mods)
+
+    def poll_state(self, translate=False):
+        #once per frame: read the keyboard, then keyState.down(key) tells what is
+        #held and keyState.key(i)/state(i)/time(i) for i < the returned count are
+        #the presses and releases since the last call. Keys are not passed on
+        #to the terminal unless translate is set
+        with self.bus:
+            self.lastPoll = time.ticks_ms()
+            self.drain(translate)
+            if translate:
+                self.sendKeys()
+            else:
+                #what the scanner queued in between is in keyState too
+                self.pendingKeys.clear()
+            return self.keyState.latch()
+
     def readinto(self, buf):
-        
-        numkeysInhardware = self.keyCount()#how many keys in hardware
-        if numkeysInhardware != 0:
-            for i in range(numkeysInhardware):
-                keyGot=self.keyEvent()
-                state = keyGot[0]
-                key = keyGot[1]
-                if state == _StatePress or state == _StateLongPress:
-
-                    if key == 0xa2 or key == 0xa3:
-                        self.isShift = True
-                    elif key == 0xa5:
-                        self.isCtrl = True
-                    elif key == 0xa1:
-                        self.isAlt = True              
-                    else:
-                        #check current shift/ctrl/alt state
-                        modifier=b''
-                        if self.isShift and self.isAlt and (not self.isCtrl):
-                            modifier=b';4'
-                        elif self.isShift and self.isCtrl and (not self.isAlt):
-                            modifier=b';6'
-                        elif self.isAlt and self.isCtrl and (not self.isShift):
-                            modifier=b';7'    
-                        elif self.isShift and self.isCtrl and self.isAlt:
-                            modifier=b';8'    
-                        elif self.isAlt and (not self.isCtrl) and (not self.isShift):
-                            modifier=b';3'    
-                        elif (not self.isAlt) and self.isCtrl and (not self.isShift):
-                            modifier=b';5'  
-                        elif (not self.isAlt) and (not self.isCtrl) and self.isShift:
-                            modifier=b';2'  
-
-                        if key >=0xB4 and key <= 0xB7:
-                        #direction keys
-                            #self.hardwarekeyBuf.append(0x1b)
-                            #self.hardwarekeyBuf.append(ord('['))
-                            if modifier != b'':
-                                parameters = b'1'
-                            else:
-                                parameters = b''
-                            if key == 0xB4:
-                                self.hardwarekeyBuf.extend(b'\x1b['+parameters+modifier+b'D')
-                            elif key == 0xB5:
-                                self.hardwarekeyBuf.extend(b'\x1b['+parameters+modifier+b'A')
-                            elif key == 0xB6:
-                                self.hardwarekeyBuf.extend(b'\x1b['+parameters+modifier+b'B')
-                            elif key == 0xB7:
-                                self.hardwarekeyBuf.extend(b'\x1b['+parameters+modifier+b'C')
-                        elif key == 0x0A:
-                            self.hardwarekeyBuf.append(ord('\r'))
-                            #self.hardwarekeyBuf.append(ord('\n')) #return key
-                        elif key == 0xB1:  # KEY_ESC
-                            self.hardwarekeyBuf.extend(b'\x1b\x1b')
-                        elif key == 0xD2: #KEY_HOME
-                            self.hardwarekeyBuf.extend(b'\x1b[H')
-                        elif key == 0xD5: #end
-                            self.hardwarekeyBuf.extend(b'\x1b[F')
-                        elif key == 0x08: #backspace
-                            self.hardwarekeyBuf.append(0x7F)
-                        elif key == 0xD4: #delete
-                            self.hardwarekeyBuf.extend(b'\x1b[3'+modifier+b'~')
-                        else:
-                            if self.isAlt == True:
-                                if key !=ord(' ') and key!=ord(',') and key!=ord('.'):
-                                    self.hardwarekeyBuf.extend(b'\x1b')#to match the vt100 terminal style
-                                    self.hardwarekeyBuf.append(key)
-                            elif self.isCtrl == True:   
-                                self.hardwarekeyBuf.append(key&0x1F)
-                            else:
-                                self.hardwarekeyBuf.append(key)
-                else:
-                    if key == 0xa2 or key == 0xa3:
-                        self.isShift = False
-                    elif key == 0xa5:
-                        self.isCtrl = False
-                    elif key == 0xa1:
-                        self.isAlt = False   
-                #self.hardwarekeyBuf.append(key[:])
-        #now deside how many keys to send to buf
-        requestedkeys = len(buf)
-        keysLeft = requestedkeys
-        if len(self.hardwarekeyBuf)==0: #after read in the key, still no key in buffer
-            return None
-        #print("init buf")
-        #print(buf)
-        #print("hardware key buf size")
-        #print(len(self.hardwarekeyBuf))
-        while keysLeft > 0:
-            
-            #fill all keys until key list is empty
-            if len(self.hardwarekeyBuf)  == 0:
-                break #all keys has been read and process
-            
-            key = self.hardwarekeyBuf.popleft()#remove the processed key from key list
-            buf[-keysLeft]=key
-            keysLeft -=1
-            
-        #print("read buff")   
-        #print(buf)
-        #print(requestedkeys-keysLeft)
-        if requestedkeys-keysLeft == 0:
-            return None
+        with self.bus:
+            self.lastRead = time.ticks_ms()
+            self.drain()
+            self.sendKeys()
+            #now deside how many keys to send to buf
+            n = self.hardwarekeyBuf.readinto(buf)
+        return n if n else None
+
+    def startScanner(self, period=20, core1=False):
+        #drain the keyboard in the background every period ms, so its FIFO does
+        #not overflow during a long computation and Ctrl+C raises KeyboardInterrupt
+        #right away. A timer does it by default, with core1 the loop running on
+        #the other core calls scan() instead
+        self.stopScanner()
+        self.scanPeriod = period
+        if not core1:
+            self.scanTimer = machine.Timer(mode=machine.Timer.PERIODIC, period=period, callback=self.scan)
+
+    def stopScanner(self):
+        if self.scanTimer is not None:
+            self.scanTimer.deinit()
+            self.scanTimer = None
+        self.scanPeriod = 0
+
+    def scan(self, timer=None):
+        if not self.scanPeriod or self.bus.busy():
+            return #stopped, or this callback interrupted a transaction of ours
+        now = time.ticks_ms()
+        if timer is None and time.ticks_diff(now, self.lastScan) < self.scanPeriod:
+            return #the core1 loop comes round more often than that
+        self.lastScan = now
+        with self.bus:
+            #while a game polls the key state the keys are its own, and while something
+            #is reading input (the REPL, the editor) Ctrl+C is just a key
+            self.drain(time.ticks_diff(now, self.lastPoll) > _READ_IDLE,
+                       time.ticks_diff(now, self.lastRead) > _READ_IDLE)
+
+class BlockCache:
+    #write-back LRU cache of 512-byte blocks, mounted in front of the SD card.
+    #Single-block requests (FAT tables and directory entries, which stat/listdir/
+    #open re-read all the time) are kept; multi-block file transfers go straight to
+    #the card and only pick up blocks the cache holds newer. Dirty blocks reach the
+    #card on sync (file close/flush), on eviction, flushMs after a write and on close().
+    #
+    #Sequential reads smaller than the readahead window (FAT reading a file a sector
+    #or a cluster at a time) fetch the next blocks with one multi-block command into a
+    #separate buffer, so streaming does not evict the metadata. The window starts at
+    #twice the request, doubles while the stream uses it up and halves when a stream
+    #stops early, up to readahead blocks (0 turns it off)
+    def __init__(self, device, blocks=32, flushMs=2000, readahead=8):
+        self.device = device
+        self.sectors = device.ioctl(4, 0)
+        self.blocks = blocks
+        self.buf = bytearray(512 * blocks)
+        self.mv = memoryview(self.buf)
+        self.slots = {} # block number -> slot
+        self.tags = array.array('i', [-1] * blocks)
+        self.used = array.array('I', [0] * blocks)
+        self.dirty = bytearray(blocks)
+        self.clock = 0
+        self.flushMs = flushMs
+        self.timer = None
+        self.busy = False
+        self.hits = 0
+        self.misses = 0
+        self.writebacks = 0
+        self.raBlocks = readahead
+        self.raBuf = bytearray(512 * readahead)
+        self.raMv = memoryview(self.raBuf)
+        self.raStart = 0
+        self.raCount = 0 # blocks in the window, 0 when empty
+        self.raUsed = 0 # blocks of the window read so far
+        self.raSize = 2 # blocks the next prefetch asks for
+        self.seqNext = -1 # block right after the previous read
+        self.prefetches = 0
+        self.prefetched = 0
+        self.raServed = 0
+
+    def _lru(self):
+        #the least recently used slot, written back and emptied
+        slot = 0
+        for i in range(1, self.blocks):
+            if self.used[i] < self.used[slot]:
+                slot = i
+        if self.tags[slot] >= 0:
+            if self.dirty[slot]:
+                self._writeback(slot)
+            del self.slots[self.tags[slot]]
+            self.tags[slot] = -1
+        return slot
+
+    def _touch(self, slot, block):
+        self.clock += 1
+        self.used[slot] = self.clock
+        self.tags[slot] = block
+        self.slots[block] = slot
+
+    def _writeback(self, slot):
+        self.device.writeblocks(self.tags[slot], self.mv[slot * 512:slot * 512 + 512])
+        self.dirty[slot] = 0
+        self.writebacks += 1
+
+    def _overlay(self, block_num, buf):
+        #dirty cached blocks are newer than what the card returned
+        end = block_num + len(buf) // 512
+        for block, slot in self.slots.items():
+            if self.dirty[slot] and block >= block_num and block < end:
+                offset = (block - block_num) * 512
+                buf[offset:offset + 512] = self.mv[slot * 512:slot * 512 + 512]
+
+    def _readahead(self, block_num, n, buf):
+        #serve the read from the readahead window, prefetching if it is sequential.
+        #False leaves the read to the other paths
+        end = self.raStart + self.raCount
+        if block_num < self.raStart or block_num + n > end:
+            if 2 * n > self.raBlocks or (block_num != self.seqNext and block_num != end):
+                return False
+            if self.raCount and block_num == end:
+                self.raSize = min(self.raSize * 2, self.raBlocks) #the stream used it all
+            elif self.raCount and self.raUsed * 2 < self.raCount:
+                self.raSize = max(self.raSize // 2, 2) #the last stream stopped early
+            count = min(max(self.raSize, 2 * n), self.raBlocks, self.sectors - block_num)
+            if count < n:
+                return False
+            self.raCount = 0
+            self.device.readblocks(block_num, self.raMv[0:count * 512])
+            self._overlay(block_num, self.raMv[0:count * 512])
+            self.raStart = block_num
+            self.raCount = count
+            self.raUsed = 0
+            self.prefetches += 1
+            self.prefetched += count
+        offset = (block_num - self.raStart) * 512
+        buf[0:n * 512] = self.raMv[offset:offset + n * 512]
+        self.raUsed = max(self.raUsed, block_num + n - self.raStart)
+        return True
+
+    def readblocks(self, block_num, buf):
+        self.busy = True
+        try:
+            n = len(buf) // 512
+            slot = self.slots.get(block_num) if n == 1 else None
+            if slot is not None:
+                self.hits += 1
+                self._touch(slot, block_num)
+                buf[0:512] = self.mv[slot * 512:slot * 512 + 512]
+            elif self.raBlocks and self._readahead(block_num, n, buf):
+                self.raServed += n
+            elif n == 1 and self.blocks:
+                self.misses += 1
+                slot = self._lru()
+                self.device.readblocks(block_num, self.mv[slot * 512:slot * 512 + 512])
+                self._touch(slot, block_num)
+                buf[0:512] = self.mv[slot * 512:slot * 512 + 512]
+            else:
+                self.device.readblocks(block_num, buf)
+                self._overlay(block_num, buf)
+            self.seqNext = block_num + n
+        finally:
+            self.busy = False
+
+    def writeblocks(self, block_num, buf):
+        self.busy = True
+        try:
+            if block_num < self.raStart + self.raCount and block_num + len(buf) // 512 > self.raStart:
+                self.raCount = 0
+            if len(buf) == 512 and self.blocks:
+                slot = self.slots.get(block_num)
+                if slot is None:
+                    slot = self._lru()
+                self._touch(slot, block_num)
+                self.mv[slot * 512:slot * 512 + 512] = buf
+                self.dirty[slot] = 1
+                self._arm()
+            else:
+                self.device.writeblocks(block_num, buf)
+                end = block_num + len(buf) // 512
+                data = memoryview(buf)
+                for block, slot in self.slots.items():
+                    if block >= block_num and block < end:
+                        offset = (block - block_num) * 512
+                        self.mv[slot * 512:slot * 512 + 512] = data[offset:offset + 512]
+                        self.dirty[slot] = 0
+        finally:
+            self.busy = False
+
+    def ioctl(self, op, arg):
+        if op == 3: # sync
+            self.flush()
+            return 0
+        if op == 2: # deinit
+            self.flush()
+        elif op == 6: # erase a block
+            self.raCount = 0
+            slot = self.slots.pop(arg, None)
+            if slot is not None:
+                self.tags[slot] = -1
+                self.used[slot] = 0
+                self.dirty[slot] = 0
+        return self.device.ioctl(op, arg)
+
+    def flush(self):
+        #write the dirty blocks back in block order
+        self.busy = True
+        try:
+            while True:
+                slot = -1
+                for i in range(self.blocks):
+                    if self.dirty[i] and (slot < 0 or self.tags[i] < self.tags[slot]):
+                        slot = i
+                if slot < 0:
+                    break
+                self._writeback(slot)
+        finally:
+            self.busy = False
+
+    def _arm(self):
+        if self.flushMs and self.timer is None:
+            self.timer = machine.Timer(mode=machine.Timer.ONE_SHOT, period=self.flushMs, callback=self._timeout)
+
+    def _timeout(self, timer):
+        self.timer = None
+        if self.busy:
+            self._arm() #the card is in use, try again later
         else:
-            return (requestedkeys-keysLeft)
+            self.flush()
+
+    def close(self):
+        if self.timer is not None:
+            self.timer.deinit()
+            self.timer = None
+        self.flush()
+
+    def readaheadStats(self, reset=False):
+        #(prefetch commands, blocks prefetched, blocks served from them, current window)
+        result = (self.prefetches, self.prefetched, self.raServed, self.raSize)
+        if reset:
+            self.prefetches = 0
+            self.prefetched = 0
+            self.raServed = 0
+        return result
+
+    def stats(self, reset=False):
+        #(hits, misses, blocks written back), hits and misses count single-block reads
+        result = (self.hits, self.misses, self.writebacks)
+        if reset:
+            self.hits = 0
+            self.misses = 0
+            self.writebacks = 0
+        return result
+
+def negotiateClock(sd, steps=_SD_CLOCKS, trials=4, clockFile='/sd_clock.txt', writeCheck=False):
+    #step the SPI clock of an initialized card up from the rate it was initialized at,
+    #keeping the fastest rate at which CRC-checked reads of a few blocks match what was
+    #read at the initial rate. Nothing is written to the card: writeCheck (never used on
+    #mount) also rewrites the last test block with what it holds and reads it back,
+    #stepping down while that fails, which risks that block if power goes or the rewrite
+    #fails. The result is stored per card (by CID) in clockFile, and a known card gets
+    #one read check at its stored rate. sd is an sdcard.SDCard or anything with its
+    #baudrate, sectors, cid(), init_spi(), init_card(), read_checked() (and writeblocks()
+    #for writeCheck), picocalc_sys.SimulatedSD is a card that fails above a chosen rate
+    safe = sd.baudrate
+    cid = ''.join('{:02x}'.format(b) for b in sd.cid())
+    probe = (0, sd.sectors // 2, sd.sectors - 1)
+    reference = []
+    for block in probe:
+        buf = bytearray(512)
+        if not sd.read_checked(block, buf):
+            raise OSError("SD card reads fail at {} Hz".format(safe))
+        reference.append(buf)
+
+    clocks = _loadClocks(clockFile)
+    known = clocks.get(cid)
+    if known:
+        if _clockOk(sd, known, probe, reference, 1):
+            return known
+        sd.init_card(safe)
+
+    passed = []
+    for freq in steps:
+        if freq <= safe:
+            continue
+        if not _clockOk(sd, freq, probe, reference, trials):
+            #a failed step can leave the card confused, start it over
+            sd.init_card(safe)
+            break
+        passed.append(freq)
+    block, data = probe[-1], reference[-1]
+    while writeCheck and passed and not _writeOk(sd, passed[-1], block, data):
+        #put the block back at the rate known to work
+        sd.init_card(safe)
+        sd.writeblocks(block, data)
+        passed.pop()
+    best = passed[-1] if passed else safe
+    sd.init_spi(best)
+    if clocks.get(cid) != best:
+        clocks[cid] = best
+        _saveClocks(clockFile, clocks)
+    return best
+
+def _clockOk(sd, freq, probe, reference, trials):
+    sd.init_spi(freq)
+    buf = bytearray(512)
+    for i in range(trials):
+        for block, expected in zip(probe, reference):
+            if not sd.read_checked(block, buf) or buf != expected:
+                return False
+    return True
+
+def _writeOk(sd, freq, block, data):
+    sd.init_spi(freq)
+    try:
+        sd.writeblocks(block, data)
+    except OSError:
+        return False
+    buf = bytearray(512)
+    return sd.read_checked(block, buf) and buf == data
+
+def _loadClocks(clockFile):
+    #"cid rate" lines
+    clocks = {}
+    try:
+        with open(clockFile, 'r') as f:
+            for line in f:
+                fields = line.split()
+                if len(fields) == 2:
+                    clocks[fields[0]] = int(fields[1])
+    except (OSError, ValueError):
+        pass
+    return clocks
+
+def _saveClocks(clockFile, clocks):
+    try:
+        with open(clockFile, 'w') as f:
+            for cid, freq in clocks.items():
+                f.write(f"{cid} {freq}\n")
+    except OSError as e:
+        print(f"{Fore.YELLOW}Could not save the SD clock: {e}")
 
 class PicoSD:
     """
@@ -355,7 +1142,7 @@ class PicoSD:
     This class handles the mounting and unmounting of the SD card, as well as checking its status.
     Also demonstrates basic uColorama usage for colored output.
     """
-    def __init__(self, mount_point="/sd", sck_pin=18, mosi_pin=19, miso_pin=16, cs_pin=17, spi_bus=0, baudrate=1000000):
+    def __init__(self, mount_point="/sd", sck_pin=18, mosi_pin=19, miso_pin=16, cs_pin=17, spi_bus=0, baudrate=None, cache=0, readahead=0):
         """
         Initialize SD card configuration.
 
@@ -365,7 +1152,9 @@ class PicoSD:
         :param miso_pin: GPIO pin connected to MISO.
         :param cs_pin: GPIO pin connected to CS.
         :param spi_bus: SPI bus to be used.
-        :param baudrate: SPI communication speed.
+        :param baudrate: SPI communication speed, None to find the fastest the card reads reliably.
+        :param cache: Blocks (512 bytes each) of write-back cache in front of the card, 0 for none.
+        :param readahead: Most blocks prefetched for sequential reads, 0 for none.
         """
         self.mount_point = mount_point
         self.sck_pin = sck_pin
@@ -374,11 +1163,17 @@ class PicoSD:
         self.cs_pin = cs_pin
         self.spi_bus = spi_bus
         self.baudrate = baudrate
+        self.clock = None
+        self.cache = cache
+        self.readahead = readahead
         self.sd = None
+        self.device = None
 
         # Attempt to mount the SD card on initialization
         self.mount()
 
+    CLOCK_FILE = '/sd_clock.txt'
+
     def __call__(self):
         """Allow the SDManager object to be called like a function to get the SDCard object."""
         if self.sd:
@@ -390,21 +1185,40 @@ class PicoSD:
         """
         if self.sd is None:
             try:
-                self.sd = sdcard.SDCard(
-                    machine.SPI(self.spi_bus, baudrate=self.baudrate, polarity=0, phase=0,
-                                sck=machine.Pin(self.sck_pin),
-                                mosi=machine.Pin(self.mosi_pin),
-                                miso=machine.Pin(self.miso_pin)),
-                    machine.Pin(self.cs_pin)
-                )
-                uos.mount(self.sd, self.mount_point)
+                spi = machine.SPI(self.spi_bus, baudrate=1000000, polarity=0, phase=0,
+                                  sck=machine.Pin(self.sck_pin),
+                                  mosi=machine.Pin(self.mosi_pin),
+                                  miso=machine.Pin(self.miso_pin))
+                if self.baudrate is None:
+                    self.sd = sdcard.SDCard(spi, machine.Pin(self.cs_pin), spi_id=self.spi_bus)
+                    self.negotiate_clock()
+                else:
+                    self.sd = sdcard.SDCard(spi, machine.Pin(self.cs_pin), self.baudrate, spi_id=self.spi_bus)
+                    self.clock = self.baudrate
+                if self.cache or self.readahead:
+                    self.device = BlockCache(self.sd, self.cache, readahead=self.readahead)
+                else:
+                    self.device = self.sd
+                uos.mount(self.device, self.mount_point)
                 print(f"{Fore.GREEN}SD card mounted successfully at", self.mount_point)
             except Exception as e:
                 print(f"{Fore.RED}Failed to mount SD card: {e}")
                 self.sd = None
+                self.device = None
         else:
             print(f"{Fore.YELLOW}SD card is already mounted.")
 
+    def negotiate_clock(self, steps=_SD_CLOCKS, trials=4):
+        """
+        Find the fastest SPI clock the mounted card works at, see negotiateClock().
+
+        :param steps: Clock rates to try, in increasing order.
+        :param trials: Reads of each test block per step.
+        :return: The clock rate in use.
+        """
+        self.clock = negotiateClock(self.sd, steps, trials, self.CLOCK_FILE)
+        return self.clock
+
     def unmount(self):
         """
         Unmount the SD card.
@@ -412,7 +1226,10 @@ class PicoSD:
         if self.sd is not None:
             try:
                 uos.umount(self.mount_point)
+                if self.device is not self.sd:
+                    self.device.close()
                 self.sd = None
+                self.device = None
                 print(f"SD card unmounted from {self.mount_point}.")
             except Exception as e:
                 print(f"{Fore.RED}Failed to unmount SD card: {e}")
@@ -549,8 +1366,9 @@ class PicoSpeaker:
 
 class PicoRTC:
     def __init__(self, i2c_id=1, sda_pin=6, scl_pin=7):
-        self.i2c = I2C(i2c_id, sda=Pin(sda_pin), scl=Pin(scl_pin))
+        self.bus = i2cBus(i2c_id, scl_pin, sda_pin)
         self.address = 0x68  # Default I2C address for PCF8523
+        self.data = bytearray(7)
     
     def bcd_to_int(self, bcd):
         return (bcd // 16) * 10 + (bcd % 16)
@@ -560,7 +1378,10 @@ class PicoRTC:
 
     def get(self):
         """Reads the current time from the PCF8523 and returns it."""
-        data = self.i2c.readfrom_mem(self.address, 0x03, 7)
+        return self.bus.cached(self.address << 8 | 0x03, _RTC_TTL, self._get)
+
+    def _get(self):
+        data = self.bus.readinto(self.address, 0x03, self.data)
         second = self.bcd_to_int(data[0] & 0x7F)
         minute = self.bcd_to_int(data[1])
         hour = self.bcd_to_int(data[2])
@@ -572,7 +1393,8 @@ class PicoRTC:
     def set(self, year, month, day, hour, minute, second):
         """Sets the time on the PCF8523."""
         year -= 2000
-        self.i2c.writeto_mem(self.address, 0x03, bytearray([
+        self.bus.invalidate(self.address << 8 | 0x03)
+        self.bus.writeto_mem(self.address, 0x03, bytearray([
             self.int_to_bcd(second),
             self.int_to_bcd(minute),
             self.int_to_bcd(hour),
@@ -13,6 +13,9 @@ import uos
 import machine
 import sdcard
 import gc
+import framebuf
+import time
+import vtterminal
 
 import errno
 
@@ -263,6 +266,285 @@ def screenshot_bmp(buffer, filename, width=320, height=320, palette=None):
             f.write(row_data)
             f.write(bytes(row_bytes - len(row_data)))  # Padding
 
+class ScreenCapture:
+    """
+    Background BMP screen capture.
+
+    request() copies the framebuffer into a snapshot slot and returns at once.
+    A timer then encodes the snapshot and writes it a few SD blocks per tick,
+    so key handling and the REPL carry on while the file is written. Requests
+    made while every slot is busy are queued (up to maxQueue) and snapshot as
+    soon as a slot frees up.
+
+    The pixel data starts on a 512 byte boundary and is written in whole
+    blocks. GS4, GS8 and MONO framebuffers are stored at their own depth,
+    GS2 is widened to 4 bits since BMP has no 2 bit format.
+    """
+    def __init__(self, display, slots=1, chunk=1024, period=10, maxQueue=8):
+        bpp = {framebuf.GS4_HMSB: 4, framebuf.GS8: 8, framebuf.GS2_HMSB: 2, framebuf.MONO_HMSB: 1}.get(display.color_type)
+        if bpp is None:
+            raise ValueError("unsupported framebuffer format")
+        self.display = display
+        self.width = display.width
+        self.height = display.height
+        self.bpp = bpp
+        self.outBpp = 4 if bpp == 2 else bpp
+        self.rowIn = self.width * bpp // 8
+        self.rowOut = (self.width * self.outBpp + 31) // 32 * 4
+        self.free = [bytearray(self.rowIn * self.height) for _ in range(slots)]
+        self.queue = []  # [filename, snapshot or None], oldest first
+        self.maxQueue = maxQueue
+        self.buf = bytearray((chunk + 511) // 512 * 512)
+        self.row = bytearray(self.rowOut)
+        self.rowMv = memoryview(self.row)
+        self.period = period
+        self.timer = None
+        self.file = None
+        self.dropped = 0
+        self.errors = 0
+        if bpp == 1:
+            # MONO_HMSB has the left pixel in bit 0, BMP in bit 7
+            self.table = bytes(int("{:08b}".format(i)[::-1], 2) for i in range(256))
+        elif bpp == 2:
+            # 4 pixels of GS2_HMSB (left in bits 0-1) to 2 bytes of 4 bit pixels
+            self.table = bytes(((i >> (4 * k)) & 3) << 4 | ((i >> (4 * k + 2)) & 3) for i in range(256) for k in range(2))
+
+    def pending(self):
+        return len(self.queue)
+
+    def request(self, filename):
+        if len(self.queue) >= self.maxQueue:
+            self.dropped += 1
+            return False
+        snap = None
+        if self.free:
+            snap = self.free.pop()
+            self._snapshot(snap)
+        self.queue.append([filename, snap])
+        if self.timer is None:
+            self.timer = machine.Timer(mode=machine.Timer.PERIODIC, period=self.period, callback=self._tick)
+        return True
+
+    def _snapshot(self, snap):
+        # output still waiting for the next frame is drawn first, or the text typed
+        # just before the capture key would be missing
+        vtterminal.flush()
+        snap[:] = self.display.buffer
+
+    def _release(self, snap):
+        # hand the slot to the oldest request still waiting for a snapshot
+        for job in self.queue:
+            if job[1] is None:
+                self._snapshot(snap)
+                job[1] = snap
+                return
+        self.free.append(snap)
+
+    def _open(self):
+        filename, snap = self.queue[0]
+        if snap is None:
+            snap = self.free.pop()
+            self._snapshot(snap)
+            self.queue[0][1] = snap
+        colors = 1 << self.outBpp
+        header = 54 + 4 * colors
+        offset = (header + 511) // 512 * 512
+        size = self.rowOut * self.height
+        lut = self.display.getLUT()
+        h = bytearray(offset)
+        h[0:2] = b"BM"
+        h[2:6] = (offset + size).to_bytes(4, "little")
+        h[10:14] = offset.to_bytes(4, "little")
+        h[14:18] = (40).to_bytes(4, "little")
+        h[18:22] = self.width.to_bytes(4, "little")
+        h[22:26] = self.height.to_bytes(4, "little")
+        h[26:28] = (1).to_bytes(2, "little")  # planes
+        h[28:30] = self.outBpp.to_bytes(2, "little")
+        h[34:38] = size.to_bytes(4, "little")
+        h[46:50] = colors.to_bytes(4, "little")
+        for i in range(colors):
+            raw = lut[i]
+            raw = ((raw & 0xFF) << 8) | (raw >> 8)
+            p = 54 + 4 * i
+            h[p] = (raw & 0x1F) << 3
+            h[p + 1] = ((raw >> 5) & 0x3F) << 2
+            h[p + 2] = ((raw >> 11) & 0x1F) << 3
+        self.file = open(filename, "wb")
+        self.file.write(h)
+        self.snap = snap
+        self.y = self.height - 1  # BMP rows go bottom-up
+        self.rowPos = self.rowOut
+
+    def _encodeRow(self, y):
+        off = y * self.rowIn
+        snap = self.snap
+        if self.bpp >= 4:
+            self.row[0:self.rowIn] = memoryview(snap)[off:off + self.rowIn]
+        elif self.bpp == 2:
+            table = self.table
+            for i in range(self.rowIn):
+                b = snap[off + i] << 1
+                self.row[2 * i] = table[b]
+                self.row[2 * i + 1] = table[b + 1]
+        else:
+            table = self.table
+            for i in range(self.rowIn):
+                self.row[i] = table[snap[off + i]]
+        self.rowPos = 0
+
+    def _tick(self, t):
+        try:
+            if self.file is None:
+                if not self.queue:
+                    self.timer.deinit()
+                    self.timer = None
+                    return
+                self._open()
+                return
+            buf = self.buf
+            n = 0
+            while n < len(buf):
+                if self.rowPos == self.rowOut:
+                    if self.y < 0:
+                        break
+                    self._encodeRow(self.y)
+                    self.y -= 1
+                take = min(len(buf) - n, self.rowOut - self.rowPos)
+                buf[n:n + take] = self.rowMv[self.rowPos:self.rowPos + take]
+                n += take
+                self.rowPos += take
+            self.file.write(memoryview(buf)[0:n])
+            if n < len(buf):
+                self._finish()
+        except Exception:
+            self.errors += 1
+            self._finish()
+
+    def _finish(self):
+        if self.file is not None:
+            try:
+                self.file.close()
+            except Exception:
+                pass
+            self.file = None
+        job = self.queue.pop(0) if self.queue else None
+        if job is not None and job[1] is not None:
+            self._release(job[1])
+
+def sdbench(sd, blocks=1024, chunk=1):
+    """
+    Measures sequential SD card reads, through the plain driver and through the
+    cache/readahead layer the card is mounted with, if any
+
+    Inputs: sd: the PicoSD (pc_sd), blocks: 512-byte blocks to read from the start of the card,
+            chunk: blocks per request (1 is how FAT reads a file in small pieces)
+    Outputs: None, prints MB/s for each
+    """
+    buf = bytearray(512 * chunk)
+    devices = [("driver", sd.sd)]
+    if sd.device is not sd.sd:
+        devices.append(("mounted", sd.device))
+    for name, device in devices:
+        start = time.ticks_ms()
+        for block in range(0, blocks - chunk + 1, chunk):
+            device.readblocks(block, buf)
+        ms = max(time.ticks_diff(time.ticks_ms(), start), 1)
+        print(f"{name:<8} {blocks * 512 / ms / 1000:.2f} MB/s ({ms} ms)")
+
+class SimulatedSD:
+    """
+    A card for picocalc.negotiateClock() that works up to readMax Hz: above it every
+    read comes back corrupted (the CRC check fails) and the card needs init_card()
+    before it answers again, above writeMax writes store corrupted data
+    """
+    def __init__(self, readMax, writeMax=None, cid=b"simulated card 0", sectors=1024):
+        self.readMax = readMax
+        self.writeMax = readMax if writeMax is None else writeMax
+        self.cidBytes = cid
+        self.sectors = sectors
+        self.blocks = {}
+        self.baudrate = 1320000
+        self.confused = False
+        self.reads = 0
+        self.writes = 0
+
+    def cid(self):
+        return self.cidBytes
+
+    def init_spi(self, baudrate):
+        self.baudrate = baudrate
+
+    def init_card(self, baudrate):
+        self.confused = False
+        self.baudrate = baudrate
+
+    def _block(self, block_num):
+        data = self.blocks.get(block_num)
+        if data is None:
+            data = bytes((block_num + i) & 0xFF for i in range(512))
+        return data
+
+    def read_checked(self, block_num, buf):
+        self.reads += 1
+        if self.confused or self.baudrate > self.readMax:
+            self.confused = True
+            buf[:] = bytes(512)
+            return False
+        buf[:] = self._block(block_num)
+        return True
+
+    def writeblocks(self, block_num, buf):
+        self.writes += 1
+        if self.confused:
+            raise OSError(5)
+        data = bytearray(buf)
+        if self.baudrate > self.writeMax:
+            data[block_num % 512] ^= 0x10
+        self.blocks[block_num] = bytes(data)
+
+def sdclock_check(readMax=15000000, writeMax=9000000):
+    """
+    Runs the SD clock negotiation against SimulatedSD cards, the card in the slot is not touched.
+    Mounting only checks reads, the "write check" case runs the opt-in write check as well
+
+    Inputs: readMax: Hz the simulated card reads up to, writeMax: Hz it writes up to
+    Outputs: True if every case settled where it should, prints each case
+    """
+    from picocalc import negotiateClock, _SD_CLOCKS
+    clockFile = "/sdclock_check.txt"
+    def expect(limit):
+        best = 1320000
+        for freq in _SD_CLOCKS:
+            if freq <= limit:
+                best = freq
+        return best
+    cases = (
+        ("new card", SimulatedSD(readMax), False, expect(readMax)),
+        ("slow writes", SimulatedSD(readMax, writeMax, cid=b"simulated card 1"), False, expect(readMax)),
+        ("write check", SimulatedSD(readMax, writeMax, cid=b"simulated card 2"), True, expect(min(readMax, writeMax))),
+        ("known card", SimulatedSD(readMax), False, expect(readMax)),
+        ("slower now", SimulatedSD(readMax // 2), False, expect(readMax // 2)),
+        ("too slow", SimulatedSD(1000000, cid=b"simulated card 3"), False, None),
+    )
+    ok = True
+    try:
+        for name, card, writeCheck, want in cases:
+            original = card._block(card.sectors - 1)
+            try:
+                got = negotiateClock(card, clockFile=clockFile, writeCheck=writeCheck)
+            except OSError:
+                got = None
+            good = (got == want and (got is None or card.baudrate == got)
+                    and card._block(card.sectors - 1) == original and (writeCheck or card.writes == 0))
+            ok = ok and good
+            print(f"{name:<12} {got} Hz, {card.reads} reads, {card.writes} writes {'ok' if good else 'FAILED, expected ' + str(want)}")
+    finally:
+        try:
+            os.remove(clockFile)
+        except OSError:
+            pass
+    return ok
+
 def read_config(file_path):
     try:
         with open(file_path, 'r') as file:
@@ -328,9 +610,10 @@ def www_upload(file_name_to_upload):
         print('Error:', e)
         
 def scan():
-    i2c = machine.I2C(1, sda=machine.Pin(6), scl=machine.Pin(7), freq=10000)
+    from picocalc import i2cBus
+    bus = i2cBus(1)
     print('Scan I2C bus...')
-    devices = i2c.scan()
+    devices = bus.scan()
     if len(devices) == 0:
       print("No Devices Found!")
     else:
@@ -338,3 +621,6 @@ def scan():
 
       for device in devices:
         print(f"Decimal: {device:3} | Hex: {hex(device)}")
+      stats = bus.stats()
+      for address in stats:
+        print(f"{hex(address)}: {stats[address][0]} transactions, {stats[address][1]} retries, {stats[address][2]} errors")
@@ -182,6 +182,8 @@ class Editor:
         "\b",
         "{chd}{file} Row: {row}/{total} Col: {col}  {msg}",
         "{chd}{file} {row}:{col}  {msg}",
+        "\x1b[?1049h",
+        "\x1b[?1049l",
     ]
     yank_buffer = []
     find_pattern = ""
@@ -234,6 +236,8 @@ class Editor:
         self.wr(
             Editor.TERMCMD[7] if onoff else Editor.TERMCMD[8]
         )
+    def alt_screen(self, onoff):
+        self.wr(Editor.TERMCMD[16] if onoff else Editor.TERMCMD[17])
     def scroll_region(self, stop):
         self.wr(
             Editor.TERMCMD[11].format(stop=stop) if stop else Editor.TERMCMD[12]
@@ -1284,35 +1288,40 @@ def pye_edit(content, tab_size=4, undo=50, io_device=None):
     else:
         slot = [Editor(tab_size, undo, io_device)]
         slot[0].get_file(current_dir)
-    while True:
-        try:
-            index %= len(slot)
-            key = slot[index].edit_loop()
-            if key == KEY_QUIT:   
-                if len(slot) == 1:
-                    #slot[0].cursor(False)
+    slot[0].alt_screen(True) #the screen underneath comes back on exit
+    try:
+        while True:
+            try:
+                index %= len(slot)
+                key = slot[index].edit_loop()
+                if key == KEY_QUIT:   
+                    if len(slot) == 1:
+                        #slot[0].cursor(False)
+                        break
+                    del slot[index]
+                elif key == KEY_GET:
+                    f = slot[index].line_edit("Open file: ", "", Editor.file_char)
+                    if f is not None:
+                        slot.append(Editor(tab_size, undo, io_device))
+                        index = len(slot) - 1
+                        slot[index].get_file(f)
+                elif key == KEY_NEXT:
+                    index += 1
+                elif key == KEY_PREV:
+                    index -= 1
+                elif key == KEY_FORCE_QUIT:
+                    #slot[0].cursor(False)#hide cursor 
                     break
-                del slot[index]
-            elif key == KEY_GET:
-                f = slot[index].line_edit("Open file: ", "", Editor.file_char)
-                if f is not None:
-                    slot.append(Editor(tab_size, undo, io_device))
-                    index = len(slot) - 1
-                    slot[index].get_file(f)
-            elif key == KEY_NEXT:
-                index += 1
-            elif key == KEY_PREV:
-                index -= 1
-            elif key == KEY_FORCE_QUIT:
-                #slot[0].cursor(False)#hide cursor 
-                break
-            elif key in slot:
-                index = slot.index(key)
-        except Exception as err:
-            slot[index].message = "{!r}".format(err)
+                elif key in slot:
+                    index = slot.index(key)
+            except Exception as err:
+                slot[index].message = "{!r}".format(err)
+    finally:
+        #also on Ctrl+C, or the alternate screen and its snapshot stay
+        slot[0].alt_screen(False)
+        picocalc.editing = False
     Editor.yank_buffer = []   
     os.chdir(current_dir)
-    picocalc.editing = False
     return slot[0].content if (slot[0].fname == "") else slot[0].fname
 try:
     import usys as sys
@@ -1,15 +1,21 @@
-from collections import deque
 import uio
 import vtterminal
 from micropython import const
 import time
 import uos
 
-from picocalc_sys import screenshot_bmp
+from picocalc_sys import screenshot_bmp, ScreenCapture
+from picocalc import ByteRing
 
 sc_char_width =  const(53)
 sc_char_height =  const(40)
 
+_MP_STREAM_FLUSH = const(1)
+_MP_STREAM_POLL = const(3)
+_MP_STREAM_CLOSE = const(4)
+_MP_STREAM_POLL_RD = const(0x0001)
+_MP_STREAM_POLL_WR = const(0x0004)
+
 def ensure_nested_dir(path):
     parts = path.split("/")
     current = ""
@@ -24,38 +30,65 @@ def ensure_nested_dir(path):
 
 class vt(uio.IOBase):
     
-    def __init__(self,framebuf,keyboard,screencaptureKey=0x15,sd=None,captureFolder="/"): #ctrl+U for screen capture
-        if sd != None:
-            if not captureFolder.startswith("/"):
-                captureFolder = "/"+captureFolder
-            captureFolder = '/sd'+captureFolder
-            if not captureFolder.endswith("/"):
-                captureFolder = captureFolder+"/"
-            self.captureFolder = captureFolder
-            ensure_nested_dir(self.captureFolder)
+    def __init__(self,framebuf,keyboard,screencaptureKey=0x15,sd=None,captureFolder="/",scrollback=16384,pollMs=10,inputSize=256): #ctrl+U for screen capture
+        if not captureFolder.startswith("/"):
+            captureFolder = "/"+captureFolder
+        captureFolder = '/sd'+captureFolder
+        if not captureFolder.endswith("/"):
+            captureFolder = captureFolder+"/"
+        self.captureFolder = captureFolder
+        self.capture = None
             
         self.framebuf = framebuf
-        self.sd = sd
+        self.sd = None
+        self.setsd(sd)
         self.keyboardInput = bytearray(30)
-        self.outputBuffer = deque((), 30)
-        vtterminal.init(self.framebuf)
+        self.responseInput = bytearray(32)
+        #keys and terminal replies waiting to be read, see inputStats()
+        self.outputBuffer = ByteRing(inputSize)
+        vtterminal.init(self.framebuf, getattr(framebuf, 'color_type', 2)) #GS4_HMSB unless the display says otherwise
+        #scrollback is a size in bytes or a ready buffer (e.g. one placed in PSRAM), ~20-60 bytes per line
+        if isinstance(scrollback, int):
+            scrollback = bytearray(scrollback) if scrollback else None
+        self.scrollback = scrollback
+        vtterminal.scrollback(self.scrollback)
         self.keyboard = keyboard
         self.screencaptureKey = screencaptureKey
+        #while no key comes in the keyboard is read at most every pollMs, waiting sleeps in between
+        self.pollMs = pollMs
+        self.keyQuiet = False
+        self.lastPoll = time.ticks_ms()
+        self.idleMs = 0
+        self.idleSince = self.lastPoll
+        self.streamReader = None
+        self.recorder = None
     
     def setsd(self, sd):
         self.sd=sd
+        if sd != None:
+            ensure_nested_dir(self.captureFolder)
         
     def screencapture(self):
+        #snapshot now, the file is written in the background (see ScreenCapture)
         if self.sd:
             filename = "{}screen_{}.bmp".format(self.captureFolder, time.ticks_ms())
-            #with open(filename, "wb") as f:
-            #    f.write(self.framebuf.buffer)
-            screenshot_bmp(self.framebuf.buffer, filename)
-            return True
+            if self.capture is None:
+                try:
+                    self.capture = ScreenCapture(self.framebuf)
+                except MemoryError:
+                    #no room for a snapshot, write it while the keys wait
+                    vtterminal.flush()
+                    screenshot_bmp(self.framebuf.buffer, filename)
+                    return True
+            return self.capture.request(filename)
         return False
 
     def dryBuffer(self):
-        self.outputBuffer = deque((), 30)
+        self.outputBuffer.clear()
+
+    def inputStats(self, reset=False):
+        #(dropped bytes, high-water mark) of the terminal input and the keyboard ring
+        return (self.outputBuffer.stats(reset), self.keyboard.hardwarekeyBuf.stats(reset))
 
         
     def stopRefresh(self):
@@ -66,41 +99,89 @@ class vt(uio.IOBase):
 
     def wr(self,input):
         #print("WR:", repr(input))
-        for c in input:
-            if ord(c) == 0x07:
-                pass
-            else:
-                vtterminal.printChar(ord(c))
+        if self.recorder:
+            self._record(input)
+        vtterminal.write(input)
         return len(input)
     
-    def write(self, buf):    
-        return self.wr(buf.decode())
+    def write(self, buf):
+        #bytes/memoryview from dupterm go to the terminal as they are, UTF-8 is decoded in C
+        if self.recorder:
+            self._record(buf)
+        return vtterminal.write(buf)
+
+    def _record(self, data):
+        #this is the console's write path, a full or removed card must not take the console
+        #down with it (dupterm drops a stream that raises), so the recording just stops
+        try:
+            self.recorder.record(data)
+        except OSError:
+            recorder = self.recorder
+            self.recorder = None
+            try:
+                recorder.file.close()
+            except OSError:
+                pass
+
+    def record(self, filename, bufSize=4096):
+        #record all output to filename until stopRecording(), see recorder and replay()
+        self.stopRecording()
+        self.recorder = recorder(filename, bufSize)
+
+    def stopRecording(self):
+        if self.recorder:
+            self.recorder.close()
+            self.recorder = None
     
     def get_screen_size(self):
         return[sc_char_height,sc_char_width]
     
     def _updateInternalBuffer(self):
-        s = vtterminal.read()
-        if s:
-            try:
-                self.outputBuffer.extend(ord(ch) for ch in s)
-            except TypeError:
-                raise ValueError("vtterminal.read() must return str")
-            except ValueError:
-                raise ValueError("Non-ASCII character in vtterminal.read()")
+        #polled in a loop, so nothing here may allocate
+        n = vtterminal.readinto(self.responseInput)
+        while n:
+            self.outputBuffer.write(self.responseInput, n)
+            n = vtterminal.readinto(self.responseInput)
 
+        now = time.ticks_ms()
+        gap = time.ticks_diff(now, self.lastPoll)
+        if self.keyQuiet:
+            if gap < self.pollMs:
+                return
+            if gap <= 4 * self.pollMs:
+                #nothing but waiting for a key happened since the last empty read
+                self.idleMs += gap
+        self.lastPoll = now
         n = self.keyboard.readinto(self.keyboardInput)
-        if n:          
-            keys = bytes(self.keyboardInput[:n])
-            if self.screencaptureKey in keys:
+        self.keyQuiet = not n
+        if n:
+            capture = False
+            for i in range(n):
+                if self.keyboardInput[i] == self.screencaptureKey:
+                    capture = True
+            self.outputBuffer.write(self.keyboardInput, n)
+            if capture:
                 self.screencapture()
-            self.outputBuffer.extend(self.keyboardInput[:n])
 
     def rd(self):
         while not self.outputBuffer:
             self._updateInternalBuffer()
+            if not self.outputBuffer:
+                #sleep_ms waits in WFE and keeps the frame timer and core1 running, unlike lightsleep
+                wait = self.pollMs - time.ticks_diff(time.ticks_ms(), self.lastPoll)
+                time.sleep_ms(wait if wait > 0 else 1)
 
         return chr(self.outputBuffer.popleft())
+
+    def idle(self, reset=False):
+        #percent of the time since the last reset spent waiting for keys
+        now = time.ticks_ms()
+        total = time.ticks_diff(now, self.idleSince)
+        percent = self.idleMs * 100 // total if total > 0 else 0
+        if reset:
+            self.idleMs = 0
+            self.idleSince = now
+        return percent
         
 
     def rd_raw(self):
@@ -108,12 +189,216 @@ class vt(uio.IOBase):
     
     def readinto(self, buf):
         self._updateInternalBuffer()
-        count = 0
-        buf_len = len(buf)
-        for i in range(buf_len):
-            if self.outputBuffer:
-                buf[i] = self.outputBuffer.popleft()
-                count += 1
-            else:
-                break
+        count = self.outputBuffer.readinto(buf)
         return count if count > 0 else None
+
+    def read(self, n=-1):
+        #what is buffered, up to n bytes, never waits
+        self._updateInternalBuffer()
+        if not self.outputBuffer:
+            return None
+        out = bytearray()
+        while self.outputBuffer and n != 0:
+            out.append(self.outputBuffer.popleft())
+            n -= 1
+        return bytes(out)
+
+    def readline(self):
+        #the buffered part of a line, up to and including the newline, never waits
+        #Enter sends \r, it ends the line as \n. None if nothing is buffered, b'' would mean EOF
+        self._updateInternalBuffer()
+        if not self.outputBuffer:
+            return None
+        out = bytearray()
+        while self.outputBuffer:
+            c = self.outputBuffer.popleft()
+            if c == 0x0d:
+                c = 0x0a
+            out.append(c)
+            if c == 0x0a:
+                break
+        return bytes(out)
+
+    def ioctl(self, req, arg):
+        #select.poll and asyncio wait on keyboard input through this, output never blocks
+        if req == _MP_STREAM_POLL:
+            ready = arg & _MP_STREAM_POLL_WR
+            if arg & _MP_STREAM_POLL_RD:
+                if not self.outputBuffer:
+                    self._updateInternalBuffer()
+                if self.outputBuffer:
+                    ready |= _MP_STREAM_POLL_RD
+            return ready
+        if req in (_MP_STREAM_FLUSH, _MP_STREAM_CLOSE):
+            return 0
+        return -1
+
+    def _reader(self):
+        if self.streamReader is None:
+            import asyncio
+            self.streamReader = asyncio.StreamReader(self)
+        return self.streamReader
+
+    async def aread(self, n=1):
+        #wait for input alongside other tasks, returns up to n bytes
+        return await self._reader().read(n)
+
+    async def areadline(self):
+        return await self._reader().readline()
+
+
+class console(uio.IOBase):
+    #an extra virtual console, Alt+F<n+1> shows console n (the REPL is console 0)
+    #output to a console that is not shown only updates its cells
+    def __init__(self):
+        self.cells = bytearray(vtterminal.CONSOLE_BYTES)
+        self.index = vtterminal.openConsole(self.cells)
+
+    def show(self):
+        vtterminal.showConsole(self.index)
+
+    def wr(self,input):
+        vtterminal.write(input, self.index)
+        return len(input)
+
+    def write(self, buf):
+        return vtterminal.write(buf, self.index)
+
+
+class recorder:
+    #terminal output with millisecond timestamps, the file is b"VTR1" followed by one record
+    #per write: [ms since the previous write][length][bytes], both numbers LEB128 varints.
+    #Records collect in a preallocated buffer that goes to the file in whole 512 byte blocks
+    def __init__(self, filename, bufSize=4096):
+        self.file = open(filename, "wb")
+        self.buf = bytearray((bufSize + 511) // 512 * 512)
+        self.mv = memoryview(self.buf)
+        #the two varints of a record header are built here, heads[k] is its first k bytes
+        self.head = bytearray(10)
+        headMv = memoryview(self.head)
+        self.heads = [headMv[0:k] for k in range(11)]
+        self.n = 0
+        self.last = time.ticks_ms()
+        self.put(b"VTR1", 4)
+
+    def flush(self):
+        self.file.write(self.buf)
+        self.n = 0
+
+    def varint(self, v, k):
+        #v as LEB128 into head from k, returns the end
+        head = self.head
+        while v >= 0x80:
+            head[k] = (v & 0x7f) | 0x80
+            v >>= 7
+            k += 1
+        head[k] = v
+        return k + 1
+
+    def put(self, data, length):
+        n = self.n
+        if n + length < len(self.buf):
+            #the usual case, one slice copy and nothing allocated
+            self.mv[n:n + length] = data
+            self.n = n + length
+            return
+        data = memoryview(data)
+        i = 0
+        while i < length:
+            take = min(length - i, len(self.buf) - self.n)
+            self.mv[self.n:self.n + take] = data[i:i + take]
+            self.n += take
+            i += take
+            if self.n == len(self.buf):
+                self.flush()
+
+    def record(self, data):
+        if type(data) is str:
+            data = data.encode() #pye writes str
+        now = time.ticks_ms()
+        k = self.varint(time.ticks_diff(now, self.last), 0)
+        self.last = now
+        length = len(data)
+        k = self.varint(length, k)
+        self.put(self.heads[k], k)
+        self.put(data, length)
+
+    def close(self):
+        if self.n:
+            self.file.write(self.mv[0:self.n])
+            self.n = 0
+        self.file.close()
+
+
+def replay(filename, speed=1, console=None, terminal=None):
+    #feed a recording back through the terminal (or to a console), speed 2 plays twice as fast
+    #and 0 as fast as it goes. Returns (bytes, ms) for use as a terminal benchmark. With a vt
+    #as terminal the output goes through its write(), so it is recorded if that is on
+    buf = bytearray(512)
+    mv = memoryview(buf)
+    with open(filename, "rb") as f:
+        end = f.readinto(buf)
+        if not end or end < 4 or buf[0:4] != b"VTR1":
+            raise ValueError("not a terminal recording")
+        pos = 4
+        total = 0
+        due = 0
+        start = time.ticks_ms()
+
+        def varint():
+            nonlocal pos, end
+            v = 0
+            shift = 0
+            while True:
+                if pos == end:
+                    end = f.readinto(buf)
+                    pos = 0
+                    if not end:
+                        return None
+                b = buf[pos]
+                pos += 1
+                v |= (b & 0x7f) << shift
+                if b < 0x80:
+                    return v
+                shift += 7
+
+        while True:
+            delta = varint()
+            if delta is None:
+                break
+            n = varint()
+            if n is None:
+                raise ValueError("recording is cut short")
+            if speed:
+                due += delta / speed
+                wait = int(due) - time.ticks_diff(time.ticks_ms(), start)
+                if wait > 0:
+                    time.sleep_ms(wait)
+            total += n
+            while n:
+                if pos == end:
+                    end = f.readinto(buf)
+                    pos = 0
+                    if not end:
+                        raise ValueError("recording is cut short")
+                take = min(n, end - pos)
+                if terminal is not None:
+                    terminal.write(mv[pos:pos + take])
+                elif console is None:
+                    vtterminal.write(mv[pos:pos + take])
+                else:
+                    vtterminal.write(mv[pos:pos + take], console)
+                pos += take
+                n -= take
+    return (total, time.ticks_diff(time.ticks_ms(), start))
+
+
+def recordOverhead(terminal, filename, target, bufSize=4096):
+    #percent that recording to target adds to replaying filename through terminal at full speed
+    plain = replay(filename, 0, terminal=terminal)[1]
+    terminal.record(target, bufSize)
+    try:
+        recorded = replay(filename, 0, terminal=terminal)[1]
+    finally:
+        terminal.stopRecording()
+    return (recorded - plain) * 100 // max(plain, 1)
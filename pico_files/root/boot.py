@@ -14,6 +14,7 @@ non_scrolling_lines = 2
 multithreading = True
 eigenmath_en = True
 show_bar = True
+key_scanner = "timer" # "timer", "core1" or None: read the keyboard in the background so Ctrl+C stops long computations
 
 # Set CPU Frequency
 try:
@@ -43,6 +44,7 @@ try:
     pc_display = PicoDisplay(320, 320, multithreading)
     
     displayflush = True
+    core1_scan = None
     def upd(timer=None):
         global displayflush
         displayflush = True
@@ -64,6 +66,8 @@ try:
                     async with asynclock:
                         with threadlock:
                             picocalcdisplay.update(0)
+                if core1_scan is not None:
+                    core1_scan()
                 await asyncio.sleep_ms(5)
 
         async def core1():
@@ -79,6 +83,11 @@ try:
 
     pc_keyboard = PicoKeyboard()
     pc_terminal = vt.vt(pc_display, pc_keyboard)
+    if key_scanner == "core1" and multithreading:
+        pc_keyboard.startScanner(core1=True)
+        core1_scan = pc_keyboard.scan
+    elif key_scanner:
+        pc_keyboard.startScanner()
     
     from picocalc import display, keyboard, terminal
     display = pc_display
@@ -140,7 +149,7 @@ try:
     pcs_R = PicoSpeaker(27)
 
     # Mount SD card
-    pc_sd = PicoSD()
+    pc_sd = PicoSD(cache=16, readahead=8)
     pc_terminal.setsd(pc_sd)
     print(f"{Fore.GREEN}Current Time and Date: {pc_rtc.time()}")
     
@@ -0,0 +1,8 @@
+SDSPI_MOD_DIR := $(USERMOD_DIR)
+
+# Add all C files to SRC_USERMOD.
+SRC_USERMOD += $(SDSPI_MOD_DIR)/sdspi.c
+
+# We can add our module folder to include paths if needed
+# This is not actually needed in this example.
+CFLAGS_USERMOD += -I$(SDSPI_MOD_DIR)
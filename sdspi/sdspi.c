@@ -0,0 +1,209 @@
+// Native SPI transport for build_files/sdcard.py: waits for the data tokens
+// and moves the 512-byte blocks by DMA, so a multi-block read or write is a
+// single call from Python instead of a loop of small SPI transfers per block.
+// Commands and chip select stay in sdcard.py, this only does the data phase.
+#include <stdint.h>
+#include <stdbool.h>
+#include <string.h>
+#include "py/runtime.h"
+#include "py/mperrno.h"
+#include "hardware/spi.h"
+#include "hardware/dma.h"
+#include "pico/time.h"
+
+#define BLOCK_SIZE      512
+#define TOKEN_DATA      0xFE
+#define READ_TIMEOUT_US 100000  // card fetching a block, 100ms in the SD spec
+#define BUSY_TIMEOUT_US 500000  // card programming a block, 250ms in the spec plus margin
+
+static const uint8_t ones = 0xFF;
+static uint8_t sink;
+
+// CRC16-CCITT (polynomial 0x1021, initial value 0), as the card appends to a data block
+static const uint16_t crcTable[256] = {
+    0x0000, 0x1021, 0x2042, 0x3063, 0x4084, 0x50a5, 0x60c6, 0x70e7,
+    0x8108, 0x9129, 0xa14a, 0xb16b, 0xc18c, 0xd1ad, 0xe1ce, 0xf1ef,
+    0x1231, 0x0210, 0x3273, 0x2252, 0x52b5, 0x4294, 0x72f7, 0x62d6,
+    0x9339, 0x8318, 0xb37b, 0xa35a, 0xd3bd, 0xc39c, 0xf3ff, 0xe3de,
+    0x2462, 0x3443, 0x0420, 0x1401, 0x64e6, 0x74c7, 0x44a4, 0x5485,
+    0xa56a, 0xb54b, 0x8528, 0x9509, 0xe5ee, 0xf5cf, 0xc5ac, 0xd58d,
+    0x3653, 0x2672, 0x1611, 0x0630, 0x76d7, 0x66f6, 0x5695, 0x46b4,
+    0xb75b, 0xa77a, 0x9719, 0x8738, 0xf7df, 0xe7fe, 0xd79d, 0xc7bc,
+    0x48c4, 0x58e5, 0x6886, 0x78a7, 0x0840, 0x1861, 0x2802, 0x3823,
+    0xc9cc, 0xd9ed, 0xe98e, 0xf9af, 0x8948, 0x9969, 0xa90a, 0xb92b,
+    0x5af5, 0x4ad4, 0x7ab7, 0x6a96, 0x1a71, 0x0a50, 0x3a33, 0x2a12,
+    0xdbfd, 0xcbdc, 0xfbbf, 0xeb9e, 0x9b79, 0x8b58, 0xbb3b, 0xab1a,
+    0x6ca6, 0x7c87, 0x4ce4, 0x5cc5, 0x2c22, 0x3c03, 0x0c60, 0x1c41,
+    0xedae, 0xfd8f, 0xcdec, 0xddcd, 0xad2a, 0xbd0b, 0x8d68, 0x9d49,
+    0x7e97, 0x6eb6, 0x5ed5, 0x4ef4, 0x3e13, 0x2e32, 0x1e51, 0x0e70,
+    0xff9f, 0xefbe, 0xdfdd, 0xcffc, 0xbf1b, 0xaf3a, 0x9f59, 0x8f78,
+    0x9188, 0x81a9, 0xb1ca, 0xa1eb, 0xd10c, 0xc12d, 0xf14e, 0xe16f,
+    0x1080, 0x00a1, 0x30c2, 0x20e3, 0x5004, 0x4025, 0x7046, 0x6067,
+    0x83b9, 0x9398, 0xa3fb, 0xb3da, 0xc33d, 0xd31c, 0xe37f, 0xf35e,
+    0x02b1, 0x1290, 0x22f3, 0x32d2, 0x4235, 0x5214, 0x6277, 0x7256,
+    0xb5ea, 0xa5cb, 0x95a8, 0x8589, 0xf56e, 0xe54f, 0xd52c, 0xc50d,
+    0x34e2, 0x24c3, 0x14a0, 0x0481, 0x7466, 0x6447, 0x5424, 0x4405,
+    0xa7db, 0xb7fa, 0x8799, 0x97b8, 0xe75f, 0xf77e, 0xc71d, 0xd73c,
+    0x26d3, 0x36f2, 0x0691, 0x16b0, 0x6657, 0x7676, 0x4615, 0x5634,
+    0xd94c, 0xc96d, 0xf90e, 0xe92f, 0x99c8, 0x89e9, 0xb98a, 0xa9ab,
+    0x5844, 0x4865, 0x7806, 0x6827, 0x18c0, 0x08e1, 0x3882, 0x28a3,
+    0xcb7d, 0xdb5c, 0xeb3f, 0xfb1e, 0x8bf9, 0x9bd8, 0xabbb, 0xbb9a,
+    0x4a75, 0x5a54, 0x6a37, 0x7a16, 0x0af1, 0x1ad0, 0x2ab3, 0x3a92,
+    0xfd2e, 0xed0f, 0xdd6c, 0xcd4d, 0xbdaa, 0xad8b, 0x9de8, 0x8dc9,
+    0x7c26, 0x6c07, 0x5c64, 0x4c45, 0x3ca2, 0x2c83, 0x1ce0, 0x0cc1,
+    0xef1f, 0xff3e, 0xcf5d, 0xdf7c, 0xaf9b, 0xbfba, 0x8fd9, 0x9ff8,
+    0x6e17, 0x7e36, 0x4e55, 0x5e74, 0x2e93, 0x3eb2, 0x0ed1, 0x1ef0
+};
+
+static uint16_t crc16(const uint8_t *p, size_t n) {
+    uint16_t crc = 0;
+    while (n--)
+        crc = (crc << 8) ^ crcTable[(crc >> 8) ^ *p++];
+    return crc;
+}
+
+static spi_inst_t *spiArg(mp_obj_t id_obj) {
+    mp_int_t id = mp_obj_get_int(id_obj);
+    if (id != 0 && id != 1)
+        mp_raise_ValueError(MP_ERROR_TEXT("SPI id must be 0 or 1"));
+    return id ? spi1 : spi0;
+}
+
+static uint8_t xfer(spi_inst_t *spi, uint8_t out) {
+    uint8_t in;
+    spi_write_read_blocking(spi, &out, &in, 1);
+    return in;
+}
+
+// first byte that is not 0xFF (the card idles the line high), -1 on timeout
+static int waitToken(spi_inst_t *spi) {
+    absolute_time_t end = make_timeout_time_us(READ_TIMEOUT_US);
+    do {
+        uint8_t b = xfer(spi, 0xFF);
+        if (b != 0xFF)
+            return b;
+    } while (!time_reached(end));
+    return -1;
+}
+
+// wait while the card holds the line low programming a block
+static bool waitReady(spi_inst_t *spi) {
+    absolute_time_t end = make_timeout_time_us(BUSY_TIMEOUT_US);
+    do {
+        if (xfer(spi, 0xFF) != 0x00)
+            return true;
+    } while (!time_reached(end));
+    return false;
+}
+
+// one full-duplex transfer: src (or 0xFF fill) out, dst (or discard) in. The
+// two DMA channels are claimed for the transfer only, so rp2.DMA users keep
+// theirs; with no two free the blocking SPI calls do it instead
+static void transfer(spi_inst_t *spi, const uint8_t *src, uint8_t *dst, size_t n) {
+    int dmaTx = dma_claim_unused_channel(false);
+    int dmaRx = (dmaTx < 0) ? -1 : dma_claim_unused_channel(false);
+    if (dmaRx < 0) {
+        if (dmaTx >= 0)
+            dma_channel_unclaim(dmaTx);
+        if (src == NULL)
+            spi_read_blocking(spi, 0xFF, dst, n);
+        else if (dst == NULL)
+            spi_write_blocking(spi, src, n);
+        else
+            spi_write_read_blocking(spi, src, dst, n);
+        return;
+    }
+    dma_channel_config c = dma_channel_get_default_config(dmaTx);
+    channel_config_set_transfer_data_size(&c, DMA_SIZE_8);
+    channel_config_set_dreq(&c, spi_get_dreq(spi, true));
+    channel_config_set_read_increment(&c, src != NULL);
+    channel_config_set_write_increment(&c, false);
+    dma_channel_configure(dmaTx, &c, &spi_get_hw(spi)->dr, src ? src : &ones, n, false);
+
+    c = dma_channel_get_default_config(dmaRx);
+    channel_config_set_transfer_data_size(&c, DMA_SIZE_8);
+    channel_config_set_dreq(&c, spi_get_dreq(spi, false));
+    channel_config_set_read_increment(&c, false);
+    channel_config_set_write_increment(&c, dst != NULL);
+    dma_channel_configure(dmaRx, &c, dst ? dst : &sink, &spi_get_hw(spi)->dr, n, false);
+
+    dma_start_channel_mask((1u << dmaTx) | (1u << dmaRx));
+    dma_channel_wait_for_finish_blocking(dmaRx);
+    dma_channel_unclaim(dmaTx);
+    dma_channel_unclaim(dmaRx);
+}
+
+static size_t blocks(mp_buffer_info_t *info) {
+    if (info->len == 0 || info->len % BLOCK_SIZE)
+        mp_raise_ValueError(MP_ERROR_TEXT("buffer length must be a multiple of 512"));
+    return info->len / BLOCK_SIZE;
+}
+
+// read(spi_id, buf, check=False): the data blocks of a CMD17/CMD18 already
+// sent with chip select low. check compares each block with the CRC the card
+// sends, a mismatch raises EIO like a missing token does
+static mp_obj_t sdspi_read(size_t n_args, const mp_obj_t *args) {
+    spi_inst_t *spi = spiArg(args[0]);
+    mp_buffer_info_t info;
+    mp_get_buffer_raise(args[1], &info, MP_BUFFER_WRITE);
+    bool check = n_args > 2 && mp_obj_is_true(args[2]);
+    uint8_t *p = info.buf;
+    for (size_t n = blocks(&info); n; n--, p += BLOCK_SIZE) {
+        int token = waitToken(spi);
+        if (token < 0)
+            mp_raise_OSError(MP_ETIMEDOUT);
+        if (token != TOKEN_DATA)
+            mp_raise_OSError(MP_EIO);
+        transfer(spi, NULL, p, BLOCK_SIZE);
+        uint16_t crc = xfer(spi, 0xFF) << 8;
+        crc |= xfer(spi, 0xFF);
+        if (check && crc != crc16(p, BLOCK_SIZE))
+            mp_raise_OSError(MP_EIO);
+    }
+    return mp_const_none;
+}
+static MP_DEFINE_CONST_FUN_OBJ_VAR_BETWEEN(sdspi_read_obj, 2, 3, sdspi_read);
+
+// write(spi_id, token, buf): each block behind token (0xFE after CMD24, 0xFC
+// after CMD25), then the data response and the wait while the card programs it
+static mp_obj_t sdspi_write(mp_obj_t id_obj, mp_obj_t token_obj, mp_obj_t buf_obj) {
+    spi_inst_t *spi = spiArg(id_obj);
+    uint8_t token = mp_obj_get_int(token_obj);
+    mp_buffer_info_t info;
+    mp_get_buffer_raise(buf_obj, &info, MP_BUFFER_READ);
+    const uint8_t *p = info.buf;
+    for (size_t n = blocks(&info); n; n--, p += BLOCK_SIZE) {
+        xfer(spi, token);
+        transfer(spi, p, NULL, BLOCK_SIZE);
+        xfer(spi, 0xFF); // CRC, ignored by the card in SPI mode
+        xfer(spi, 0xFF);
+        if ((xfer(spi, 0xFF) & 0x1F) != 0x05)
+            mp_raise_OSError(MP_EIO);
+        if (!waitReady(spi))
+            mp_raise_OSError(MP_ETIMEDOUT);
+    }
+    return mp_const_none;
+}
+static MP_DEFINE_CONST_FUN_OBJ_3(sdspi_write_obj, sdspi_write);
+
+static mp_obj_t sdspi_crc16(mp_obj_t buf_obj) {
+    mp_buffer_info_t info;
+    mp_get_buffer_raise(buf_obj, &info, MP_BUFFER_READ);
+    return MP_OBJ_NEW_SMALL_INT(crc16(info.buf, info.len));
+}
+static MP_DEFINE_CONST_FUN_OBJ_1(sdspi_crc16_obj, sdspi_crc16);
+
+static const mp_rom_map_elem_t sdspi_globals_table[] = {
+    { MP_ROM_QSTR(MP_QSTR___name__), MP_ROM_QSTR(MP_QSTR_sdspi) },
+    { MP_ROM_QSTR(MP_QSTR_read), MP_ROM_PTR(&sdspi_read_obj) },
+    { MP_ROM_QSTR(MP_QSTR_write), MP_ROM_PTR(&sdspi_write_obj) },
+    { MP_ROM_QSTR(MP_QSTR_crc16), MP_ROM_PTR(&sdspi_crc16_obj) },
+};
+static MP_DEFINE_CONST_DICT(sdspi_globals, sdspi_globals_table);
+
+const mp_obj_module_t sdspi_cmodule = {
+    .base = { &mp_type_module },
+    .globals = (mp_obj_dict_t*)&sdspi_globals,
+};
+
+MP_REGISTER_MODULE(MP_QSTR_sdspi, sdspi_cmodule);
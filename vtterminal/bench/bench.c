@@ -0,0 +1,166 @@
+// Host benchmark for the vtterminal module.
+//
+// Builds vtterminal.c on Linux against the stubs in stubs/ (no MicroPython,
+// no pico SDK), replays terminal byte streams into it and reports throughput,
+// how many glyph cells were rasterized, how many lines were scrolled and a
+// hash of the final framebuffer, so an optimization can be checked for both
+// speed and pixel exact output.
+//
+//   ./vtbench [-r repeat] [-f frame_bytes] [-s scrollback_bytes] [-p format] file.vt ...
+//
+// -f renders every frame_bytes input bytes, standing in for the 25ms frame
+// timer, 0 renders only once at the end. The hash does not depend on it.
+// -p is the framebuffer format as numbered by framebuf, 2 (GS4_HMSB) by default.
+// A file may also be a session recorded on the device with vt.record(), its
+// output is replayed without the timing.
+#include <stdio.h>
+#include <stdlib.h>
+#include <string.h>
+#include <time.h>
+#include <unistd.h>
+
+static unsigned long stat_glyphs, stat_lines, stat_bandMoves;
+#define VT_STAT(counter, n) (stat_##counter += (n))
+
+#include "vtterminal.c"
+
+const int mp_type_module = 0;
+
+static uint8_t frame[SC_PIXEL_WIDTH * SC_PIXEL_HEIGHT]; // large enough for GS8
+static int format = FB_GS4_HMSB;
+static uint8_t history[1 << 20];
+
+static uint8_t *load(const char *path, size_t *len) {
+    FILE *f = fopen(path, "rb");
+    if (f == NULL) {
+        perror(path);
+        exit(1);
+    }
+    fseek(f, 0, SEEK_END);
+    *len = ftell(f);
+    fseek(f, 0, SEEK_SET);
+    uint8_t *data = malloc(*len ? *len : 1);
+    if (fread(data, 1, *len, f) != *len) {
+        perror(path);
+        exit(1);
+    }
+    fclose(f);
+    return data;
+}
+
+static size_t varint(const uint8_t *data, size_t len, size_t *pos) {
+    size_t v = 0;
+    for (int shift = 0; *pos < len; shift += 7) {
+        uint8_t b = data[(*pos)++];
+        v |= (size_t)(b & 0x7f) << shift;
+        if (b < 0x80)
+            break;
+    }
+    return v;
+}
+
+// strip a vt.record() file ("VTR1", then [ms][length][bytes] records with
+// LEB128 numbers) down to the terminal output it holds
+static void unpackRecording(uint8_t *data, size_t *len) {
+    if (*len < 4 || memcmp(data, "VTR1", 4) != 0)
+        return;
+    size_t in = 4, out = 0;
+    while (in < *len) {
+        varint(data, *len, &in); // ms since the previous write
+        size_t n = varint(data, *len, &in);
+        if (n > *len - in)
+            n = *len - in;
+        memmove(data + out, data + in, n);
+        in += n;
+        out += n;
+    }
+    *len = out;
+}
+
+static double now(void) {
+    struct timespec ts;
+    clock_gettime(CLOCK_MONOTONIC, &ts);
+    return ts.tv_sec + ts.tv_nsec * 1e-9;
+}
+
+static uint32_t frameHash(void) {
+    uint32_t h = 2166136261u; // FNV-1a
+    for (size_t i = 0; i < fbSize; i++) {
+        h ^= frame[i];
+        h *= 16777619u;
+    }
+    return h;
+}
+
+// one replay from a freshly initialized terminal
+static void replay(const uint8_t *data, size_t len, size_t frameBytes, size_t historyBytes) {
+    size_t bpp = (format == FB_GS8) ? 8 : (format == FB_GS2_HMSB) ? 2 : (format == FB_MONO_HMSB) ? 1 : 4;
+    mp_buffer_info_t fbInfo = { frame, SC_PIXEL_WIDTH * SC_PIXEL_HEIGHT * bpp / 8, 'B' };
+    mp_buffer_info_t histInfo = { history, historyBytes, 'B' };
+    mp_obj_t initArgs[2] = { (mp_obj_t)&fbInfo, MP_OBJ_NEW_SMALL_INT(format) };
+    vtterminal_init(2, initArgs);
+    if (historyBytes)
+        vt_scrollback((mp_obj_t)&histInfo);
+    // output arrives the way vt.write() passes it on, a chunk per frame
+    size_t chunk = frameBytes ? frameBytes : len;
+    for (size_t i = 0; i < len; i += chunk) {
+        size_t n = (len - i < chunk) ? len - i : chunk;
+        mp_buffer_info_t out = { (void *)(data + i), n, 'B' };
+        mp_obj_t writeArgs[1] = { (mp_obj_t)&out };
+        vt_write(1, writeArgs);
+        if (frameBytes && n == chunk)
+            vt_flush(0, NULL);
+    }
+    vt_flush(0, NULL);
+}
+
+int main(int argc, char **argv) {
+    int repeat = 20;
+    size_t frameBytes = 2048;
+    size_t historyBytes = 16384;
+    int opt;
+    while ((opt = getopt(argc, argv, "r:f:s:p:")) != -1) {
+        switch (opt) {
+            case 'r': repeat = atoi(optarg); break;
+            case 'f': frameBytes = strtoul(optarg, NULL, 0); break;
+            case 's': historyBytes = strtoul(optarg, NULL, 0); break;
+            case 'p': format = atoi(optarg); break;
+            default:
+                fprintf(stderr, "usage: %s [-r repeat] [-f frame_bytes] [-s scrollback_bytes] [-p format] file.vt ...\n", argv[0]);
+                return 2;
+        }
+    }
+    if (repeat < 1) repeat = 1;
+    if (historyBytes > sizeof(history)) historyBytes = sizeof(history);
+
+    printf("%-12s %8s %12s %8s %7s %6s %6s %8s\n",
+        "corpus", "bytes", "chars/s", "glyphs", "lines", "moves", "hit%", "fb hash");
+    for (int a = optind; a < argc; a++) {
+        size_t len;
+        uint8_t *data = load(argv[a], &len);
+        unpackRecording(data, &len);
+        const char *name = strrchr(argv[a], '/');
+        name = name ? name + 1 : argv[a];
+
+        // counters and the hash come from a single replay
+        stat_glyphs = stat_lines = stat_bandMoves = 0;
+        memset(glyphKey, 0, sizeof(glyphKey)); // every corpus starts with a cold cache
+        glyphHits = glyphMisses = 0;
+        replay(data, len, frameBytes, historyBytes);
+        uint32_t hash = frameHash();
+        unsigned long glyphs = stat_glyphs, lines = stat_lines, moves = stat_bandMoves;
+        unsigned long lookups = glyphHits + glyphMisses;
+        double hitRate = lookups ? 100.0 * glyphHits / lookups : 0.0;
+
+        double t0 = now();
+        for (int r = 0; r < repeat; r++)
+            replay(data, len, frameBytes, historyBytes);
+        double elapsed = now() - t0;
+
+        printf("%-12s %8zu %12.0f %8lu %7lu %6lu %6.1f %08x\n",
+            name, len, elapsed > 0 ? (double)len * repeat / elapsed : 0.0,
+            glyphs, lines, moves, hitRate, hash);
+        free(data);
+    }
+    return 0;
+}
@@ -0,0 +1,235 @@
+"""
+Generate the replay corpora for the vtterminal host benchmark.
+
+Each corpus is the raw byte stream the terminal would receive on the device,
+reconstructed from what the PicoCalc libraries actually emit (boot header,
+REPL echo, pye redraws, files() listings, colorer output).  The generator is
+seeded, so the corpora and therefore the framebuffer hashes are stable.
+
+Usage: python3 gen_corpus.py [output_dir]
+"""
+import os
+import random
+import sys
+
+ESC = "\x1b"
+CSI = ESC + "["
+
+ROWS = 40
+COLS = 53
+
+WORDS = (
+    "import time gc machine display terminal keyboard print range len str int "
+    "def return while for in if else elif True False None pass break class "
+    "self buffer value count index result sdcard mount picocalc vt pye"
+).split()
+
+
+def header(rng):
+    # boot.py: scroll region below the two header lines, then the header
+    # redraw that update_header() repeats every five seconds
+    desc = "PicoCalc MicroPython (ver 1.25.0)"
+    pad = " " * ((COLS - len(desc)) // 2)
+    line1 = pad + desc + " " * (COLS - len(pad) - len(desc))
+    left = "Battery: {}%".format(rng.randint(10, 100))
+    right = "04/{:02}/2025 12:{:02}:{:02}".format(rng.randint(1, 28), rng.randint(0, 59), rng.randint(0, 59))
+    line2 = left + " " * (COLS - len(left) - len(right)) + right
+    return (ESC + "7" + CSI + "1;1H" + CSI + "5m" + line1 + CSI + "0m"
+            + CSI + "2;1H" + CSI + "5m" + line2 + CSI + "0m" + ESC + "8")
+
+
+def sentence(rng, lo, hi):
+    return " ".join(rng.choice(WORDS) for _ in range(rng.randint(lo, hi)))
+
+
+def repl(rng):
+    out = [CSI + "3;40r", "\r\n"]
+    out.append(header(rng))
+    for n in range(120):
+        out.append(">>> ")
+        cmd = sentence(rng, 1, 6)
+        for ch in cmd:
+            out.append(ch)
+            if rng.random() < 0.05:
+                # REPL line editing: backspace, erase to end of line, retype
+                out.append("\x08" + CSI + "K" + ch)
+        out.append("\r\n")
+        kind = rng.random()
+        if kind < 0.3:
+            for i in range(rng.randint(1, 25)):
+                out.append("{}\r\n".format(i * rng.randint(1, 999)))
+        elif kind < 0.4:
+            out.append("Traceback (most recent call last):\r\n")
+            out.append('  File "<stdin>", line 1, in <module>\r\n')
+            out.append("NameError: name '{}' isn't defined\r\n".format(rng.choice(WORDS)))
+        elif kind < 0.5:
+            # progress counter rewritten in place
+            for i in range(0, 101, 2):
+                out.append("\rprogress {:3}%".format(i))
+            out.append("\r\n")
+        else:
+            out.append(sentence(rng, 2, 14) + "\r\n")
+        if n % 25 == 0:
+            out.append(header(rng))
+    return "".join(out)
+
+
+def highlight(rng, line):
+    styles = [CSI + "37;44m", CSI + "37;45m", CSI + "37;46m", CSI + "36m", CSI + "32m", CSI + "33m"]
+    parts = []
+    for word in line.split(" "):
+        if rng.random() < 0.3:
+            parts.append(rng.choice(styles) + word + CSI + "0m")
+        else:
+            parts.append(word)
+    return " ".join(parts)
+
+
+def pye(rng):
+    height = ROWS - 1
+    lines = ["    " * rng.randint(0, 3) + sentence(rng, 1, 8) for _ in range(400)]
+    out = [CSI + "?25l", CSI + "1;{}r".format(height), CSI + "?9h"]
+
+    def status(row, col):
+        out.append(CSI + "{};1H".format(ROWS) + CSI + "1;37;44m")
+        out.append("main.py Row: {}/{} Col: {}  ".format(row, len(lines), col)[:COLS] + CSI + "0K" + CSI + "0m")
+
+    def window(top):
+        out.append(CSI + "?25l")
+        for r in range(height):
+            out.append(CSI + "{};1H".format(r + 1))
+            out.append(highlight(rng, lines[top + r][:COLS]))
+            out.append(CSI + "0K")
+        status(top + 1, 1)
+        out.append(CSI + "1;1H" + CSI + "?25h")
+
+    top = 0
+    window(top)
+    for step in range(300):
+        action = rng.random()
+        if action < 0.4 and top + height < len(lines):
+            # cursor down past the bottom: scroll_down writes "\n"
+            top += 1
+            out.append(CSI + "?25l" + CSI + "{};1H".format(height) + "\n")
+            out.append(CSI + "{};1H".format(height) + highlight(rng, lines[top + height - 1][:COLS]) + CSI + "0K")
+        elif action < 0.6 and top > 0:
+            # cursor up past the top: scroll_up writes ESC M
+            top -= 1
+            out.append(CSI + "?25l" + CSI + "1;1H" + ESC + "M")
+            out.append(CSI + "1;1H" + highlight(rng, lines[top][:COLS]) + CSI + "0K")
+        elif action < 0.9:
+            # typing on the current line redraws it
+            r = rng.randint(0, height - 1)
+            lines[top + r] = (lines[top + r] + rng.choice(WORDS))[:COLS]
+            out.append(CSI + "{};1H".format(r + 1) + highlight(rng, lines[top + r]) + CSI + "0K")
+        else:
+            # page down: full window redraw
+            top = min(top + height, len(lines) - height)
+            window(top)
+        status(top + 1, rng.randint(1, COLS))
+        out.append(CSI + "{};{}H".format(rng.randint(1, height), rng.randint(1, COLS)) + CSI + "?25h")
+    out.append(CSI + "r" + CSI + "?9l" + CSI + "{};1H".format(ROWS) + CSI + "0K")
+    return "".join(out)
+
+
+def files(rng):
+    out = [CSI + "3;40r", CSI + "40;1H"]
+    out.append("Contents of Directory: /sd\r\n" + CSI + "0m")
+    for i in range(40):
+        out.append("{:<25} <DIR>".format("dir{:03}".format(i)) + CSI + "0m\r\n")
+    for i in range(200):
+        name = "{}_{:03}.py".format(rng.choice(WORDS), i)
+        size = "{:.2f} KB".format(rng.random() * 200)
+        out.append("{:<25} {:<9}".format(name, size) + CSI + "0m\r\n")
+    return "".join(out)
+
+
+def colorer(rng):
+    fores = [CSI + "{}m".format(30 + i) for i in range(8)] + [CSI + "39m", CSI + "48;5;250m"]
+    backs = [CSI + "{}m".format(40 + i) for i in range(8)] + [CSI + "49m"]
+    styles = [CSI + "1m", CSI + "22m", CSI + "4m", CSI + "5m", CSI + "7m", CSI + "27m", CSI + "0m"]
+    out = [CSI + "2J" + CSI + "H"]
+    for _ in range(600):
+        seq = rng.choice(fores)
+        if rng.random() < 0.5:
+            seq += rng.choice(backs)
+        if rng.random() < 0.4:
+            seq += rng.choice(styles)
+        out.append(seq + sentence(rng, 1, 4) + CSI + "0m")
+        out.append(" " if rng.random() < 0.8 else "\r\n")
+    return "".join(out)
+
+
+def controls(rng):
+    # exercises every cell/line operation the emulator implements
+    out = [CSI + "2J" + CSI + "H"]
+    for r in range(ROWS):
+        out.append(CSI + "{};1H".format(r + 1) + CSI + "3{}m".format(r % 8) + sentence(rng, 4, 8)[:COLS])
+    out.append(CSI + "0m")
+    top, bottom = 1, ROWS
+    for _ in range(400):
+        op = rng.randrange(16)
+        y, x = rng.randint(1, ROWS), rng.randint(1, COLS)
+        if op == 0:
+            # IL/DL only act inside the scroll region
+            y = rng.randint(top, bottom)
+            out.append(CSI + "{};{}H".format(y, x) + CSI + "{}L".format(rng.randint(1, 5)))
+        elif op == 1:
+            y = rng.randint(top, bottom)
+            out.append(CSI + "{};{}H".format(y, x) + CSI + "{}M".format(rng.randint(1, 5)))
+        elif op == 2:
+            out.append(CSI + "{};{}H".format(y, x) + CSI + "{}J".format(rng.randint(0, 1)))
+        elif op == 3:
+            out.append(CSI + "{};{}H".format(y, x) + CSI + "{}K".format(rng.randint(0, 2)))
+        elif op == 4:
+            out.append(CSI + "4h" + CSI + "{};{}H".format(y, x) + sentence(rng, 1, 2) + CSI + "4l")
+        elif op == 5:
+            top = rng.randint(1, ROWS - 2)
+            bottom = rng.randint(top + 1, ROWS)
+            out.append(CSI + "{};{}r".format(top, bottom))
+        elif op == 6:
+            out.append(CSI + "{};{}H".format(y, x) + (ESC + "M") * rng.randint(1, 3))
+        elif op == 7:
+            out.append(CSI + "{}A".format(rng.randint(1, 45)))
+        elif op == 8:
+            out.append(CSI + "{};{}H".format(y, x) + "\n" * rng.randint(1, 6))
+        elif op == 9:
+            out.append(CSI + "{};{}H".format(y, x) + ESC + "D" + ESC + "E")
+        elif op == 10:
+            out.append(CSI + "{};{}H".format(y, x) + "\x0e" + str(rng.randrange(10 ** 6)) + "\x0f" + "\x7f\x7f")
+        elif op == 11:
+            out.append(CSI + "{};{}H".format(y, x) + CSI + "1;7;3{}m".format(rng.randrange(8)) + sentence(rng, 1, 3) + CSI + "0m")
+        elif op == 12:
+            out.append(CSI + "38;2;200;10;250m" + CSI + "48;5;{}m".format(rng.randrange(256)) + sentence(rng, 1, 2) + CSI + "0m")
+        elif op == 13:
+            out.append(CSI + "{};{}H".format(y, x) + "\t" + "x" + "\x08\x08y")
+        elif op == 14:
+            out.append(CSI + "?7l" + CSI + "{};40H".format(y) + sentence(rng, 4, 6) + CSI + "?7h")
+        else:
+            out.append(CSI + "{};{}H".format(y, x) + sentence(rng, 2, 12))
+    out.append(CSI + "r" + CSI + "?5h" + "inverse" + CSI + "?5l" + ESC + "#8" + CSI + "20;1H" + CSI + "1J")
+    return "".join(out)
+
+
+CORPORA = {
+    "repl": repl,
+    "pye": pye,
+    "files": files,
+    "colorer": colorer,
+    "controls": controls,
+}
+
+
+def main():
+    out_dir = sys.argv[1] if len(sys.argv) > 1 else os.path.join(os.path.dirname(__file__), "corpus")
+    if not os.path.isdir(out_dir):
+        os.mkdir(out_dir)
+    for name, gen in CORPORA.items():
+        data = gen(random.Random(name)).encode("latin-1")
+        with open(os.path.join(out_dir, name + ".vt"), "wb") as f:
+            f.write(data)
+        print("{:<10} {:>8} bytes".format(name, len(data)))
+
+
+if __name__ == "__main__":
+    main()
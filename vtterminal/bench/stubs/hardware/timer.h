@@ -0,0 +1 @@
+// host stand-in, vtterminal.c needs nothing from this header
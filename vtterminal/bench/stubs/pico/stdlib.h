@@ -0,0 +1,16 @@
+// Host stand-in for the pico SDK pieces vtterminal uses: the repeating timer
+// is accepted and never fires, so the cursor stays hidden during a replay.
+#ifndef BENCH_PICO_STDLIB_H
+#define BENCH_PICO_STDLIB_H
+#include <stdbool.h>
+#include <stdint.h>
+
+typedef struct repeating_timer { int unused; } repeating_timer_t;
+typedef bool (*repeating_timer_callback_t)(repeating_timer_t *rt);
+
+static inline bool add_repeating_timer_ms(int32_t delay_ms, repeating_timer_callback_t callback, void *user_data, repeating_timer_t *out) {
+    (void)delay_ms; (void)callback; (void)user_data; (void)out;
+    return true;
+}
+static inline bool cancel_repeating_timer(repeating_timer_t *timer) { (void)timer; return true; }
+#endif
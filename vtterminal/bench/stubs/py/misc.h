@@ -0,0 +1,9 @@
+// host stand-in for the MicroPython heap helpers vtterminal.c uses
+#ifndef BENCH_PY_MISC_H
+#define BENCH_PY_MISC_H
+#include <stdlib.h>
+#ifndef m_new_maybe
+#define m_new_maybe(type, num) ((type *)malloc(sizeof(type) * (num)))
+#endif
+#define m_del(type, ptr, num) free(ptr)
+#endif
@@ -0,0 +1,69 @@
+// Minimal MicroPython API stand-in so vtterminal.c builds on the host.
+// Only what the terminal module touches is provided.
+#ifndef BENCH_PY_RUNTIME_H
+#define BENCH_PY_RUNTIME_H
+#include <stdint.h>
+#include <stddef.h>
+#include <stdbool.h>
+#include <stdlib.h>
+#include <stdio.h>
+
+typedef void *mp_obj_t;
+typedef intptr_t mp_int_t;
+typedef uintptr_t mp_uint_t;
+
+typedef struct { const void *type; } mp_obj_base_t;
+typedef struct { const void *key; const void *value; } mp_rom_map_elem_t;
+typedef struct { const mp_rom_map_elem_t *table; } mp_obj_dict_t;
+typedef struct { mp_obj_base_t base; mp_obj_dict_t *globals; } mp_obj_module_t;
+typedef struct { void *buf; size_t len; int typecode; } mp_buffer_info_t;
+
+extern const int mp_type_module;
+
+#define MP_BUFFER_READ  (1)
+#define MP_BUFFER_WRITE (2)
+#define MP_BUFFER_RW    (3)
+
+#define MP_OBJ_NULL    ((mp_obj_t)0)
+#define mp_const_none  ((mp_obj_t)0)
+#define mp_const_false ((mp_obj_t)0)
+#define mp_const_true  ((mp_obj_t)1)
+#define MP_OBJ_NEW_SMALL_INT(i) ((mp_obj_t)(intptr_t)(i))
+#define MP_OBJ_FROM_PTR(p) ((mp_obj_t)(p))
+
+static inline mp_int_t mp_obj_get_int(mp_obj_t o) { return (mp_int_t)o; }
+static inline bool mp_obj_is_true(mp_obj_t o) { return o != 0; }
+static inline mp_obj_t mp_obj_new_bool(bool b) { return (mp_obj_t)(intptr_t)b; }
+static inline mp_obj_t mp_obj_new_int(mp_int_t i) { return (mp_obj_t)i; }
+static inline mp_obj_t mp_obj_new_int_from_uint(mp_uint_t i) { return (mp_obj_t)i; }
+static inline mp_obj_t mp_obj_new_tuple(size_t n, const mp_obj_t *items) { (void)n; (void)items; return mp_const_none; }
+static inline mp_obj_t mp_obj_new_str(const char *s, size_t len) { (void)s; (void)len; return mp_const_none; }
+
+#define MP_ERROR_TEXT(s) s
+static inline void mp_raise_ValueError(const char *msg) { fprintf(stderr, "ValueError: %s\n", msg); exit(1); }
+
+// Nothing runs scheduled callbacks on the host; the bench renders explicitly.
+static inline bool mp_sched_schedule(mp_obj_t function, mp_obj_t arg) { (void)function; (void)arg; return true; }
+static inline void mp_sched_keyboard_interrupt(void) {}
+
+// Buffer objects are passed as mp_buffer_info_t pointers by the bench.
+static inline void mp_get_buffer_raise(mp_obj_t o, mp_buffer_info_t *info, int flags) {
+    (void)flags;
+    *info = *(mp_buffer_info_t *)o;
+}
+
+#define MP_DEFINE_CONST_FUN_OBJ_0(obj, fun) const void *obj = (const void *)fun
+#define MP_DEFINE_CONST_FUN_OBJ_1(obj, fun) const void *obj = (const void *)fun
+#define MP_DEFINE_CONST_FUN_OBJ_2(obj, fun) const void *obj = (const void *)fun
+#define MP_DEFINE_CONST_FUN_OBJ_3(obj, fun) const void *obj = (const void *)fun
+#define MP_DEFINE_CONST_FUN_OBJ_VAR_BETWEEN(obj, lo, hi, fun) const void *obj = (const void *)fun
+#define MP_ROM_QSTR(q) ((const void *)0)
+#define MP_ROM_PTR(p) ((const void *)(p))
+#define MP_ROM_INT(i) ((const void *)(intptr_t)(i))
+#define MP_DEFINE_CONST_DICT(name, table) const mp_obj_dict_t name = { table }
+#define MP_REGISTER_MODULE(name, mod)
+// root pointers become plain statics, there is no GC to hide them from
+#define MP_REGISTER_ROOT_POINTER(decl) static decl
+#define MP_STATE_VM(x) (x)
+
+#endif
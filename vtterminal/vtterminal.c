@@ -16,6 +16,11 @@
 #include "pico/stdlib.h"
 #include "hardware/timer.h"
 
+// counters for the host benchmark (bench/), compiled out in the firmware
+#ifndef VT_STAT
+#define VT_STAT(counter, n)
+#endif
+
 
 uint8_t* fontTop;
                
@@ -31,6 +36,11 @@ uint16_t M_BOTTOM = SC_H - 1;
 #define MAX_SC_Y  (SC_H - 1)    
 #define MAX_SP_X  (SP_W - 1)     
 #define MAX_SP_Y  (SP_H - 1)     
+// framebuffer formats, same numbers as the framebuf module
+#define FB_GS4_HMSB   2
+#define FB_MONO_HMSB  4
+#define FB_GS2_HMSB   5
+#define FB_GS8        6
 
 typedef struct {
     uint8_t Bold  : 1;      // 1
@@ -40,7 +50,7 @@ typedef struct {
     uint8_t Blink : 1;      // 5 (Slow Blink)
     uint8_t RapidBlink : 1; // 6
     uint8_t Reverse : 1;    // 7
-    uint8_t Conceal : 1;    // 8
+    uint8_t G1 : 1;         // cell was written with the G1 charset (SO), SGR 8 Conceal is not supported
   }TATTR ;
   
   typedef union {
@@ -52,12 +62,14 @@ typedef struct {
 
 
 
+// color indexes, 0-15 except on a GS8 framebuffer where SGR 38;5/48;5 keep
+// the full 256 color index
 typedef struct {
-    uint8_t Foreground : 4;
-    uint8_t Background : 4;
+    uint8_t Foreground;
+    uint8_t Background;
 }TCOLOR ;
 typedef union {
-    uint8_t value;
+    uint16_t value;
     TCOLOR Color;
 }COLOR ;
   
@@ -97,14 +109,68 @@ typedef union {
     TMODE_EX Flgs;
 }MODE_EX ;
 
-char outputBuf[30]={0};
-int outputLen = 0;
-uint8_t screen[SCSIZE];      
-uint8_t attrib[SCSIZE];      
-uint8_t colors[SCSIZE];      
+// replies to the host (DA, DSR, CPR) waiting to be read, a ring so polling
+// allocates nothing; a reply that does not fit is dropped whole, never cut
+#define VT_RESP_SIZE 128
+static uint8_t respBuf[VT_RESP_SIZE];
+static uint16_t respHead = 0;
+static uint16_t respLen = 0;
+// cells of console 0, the arrays of the console being written are reached
+// through screen/attrib/colors
+static uint8_t screen0[SCSIZE];
+static uint8_t attrib0[SCSIZE];
+static uint16_t colors0[SCSIZE];
+uint8_t *screen = screen0;
+uint8_t *attrib = attrib0;
+uint16_t *colors = colors0;
 uint8_t tabs[SC_W];  
 uint8_t *fb;
-const uint8_t *currentTextTable;
+static size_t fbSize = 0;
+static uint8_t fbFormat = FB_GS4_HMSB;
+static uint8_t fbBpp = 4;
+static uint16_t fbRowBytes = SC_PIXEL_WIDTH >> 1;  // one pixel row
+static uint16_t fbLineBytes = (SC_PIXEL_WIDTH >> 1) * CH_H; // one 8 pixel high text line
+// 16 color index to a gray level on a GS2 framebuffer, the display LUT holds
+// black, dark gray, light gray, white there. MONO has black and white only
+static const uint8_t gs2Level[16] = {0, 1, 1, 1, 1, 1, 1, 2, 1, 1, 2, 3, 1, 2, 2, 3};
+// one bit per column, set when the cell changed since it was last rasterized
+static uint64_t dirty[SC_H];
+#define ALL_COLS  ((((uint64_t)1) << SC_W) - 1)
+static volatile bool needRender = false;
+// framebuffer scroll still owed for the cells that already moved: bursts of
+// line feeds collapse into a single band move at the next render
+static uint16_t scrollTop = 0;
+static uint16_t scrollBottom = 0;
+static int16_t scrollPending = 0;     // lines to move up, negative moves down
+// scrollback: lines leaving the top of a region that reaches the last row are
+// appended to a ring of variable sized records, trailing blanks trimmed and
+// attributes/colors stored as runs:
+//   [len][len chars][nruns][nruns x (count, attrib, color lo, hi)][record size lo, hi]
+static uint8_t *hist = NULL;
+static uint32_t histSize = 0;
+static uint32_t histHead = 0;         // oldest record
+static uint32_t histTail = 0;         // next free byte
+static uint32_t histUsed = 0;
+static uint32_t histLines = 0;
+static uint32_t viewOffset = 0;       // lines the view is scrolled back, 0 is the live screen
+static uint16_t viewTop = 0;          // first screen line replaced by the view
+static bool viewDirty = false;
+#define HIST_REC_MAX (1 + SC_W + 1 + 4 * SC_W + 2)
+// rendered cells, 6x8 pixels at 4bpp start on a byte: 3 bytes by 8 rows.
+// Keyed by char, final fore/back colors, bold and charset, LRU per set
+#define GLYPH_SETS      64
+#define GLYPH_WAYS      4
+#define GLYPH_VALID     0x80000000
+#define CELL_ROW_BYTES  (CH_W >> 1)
+static uint32_t glyphKey[GLYPH_SETS][GLYPH_WAYS];
+static uint32_t glyphUsed[GLYPH_SETS][GLYPH_WAYS];
+static uint8_t glyphCell[GLYPH_SETS][GLYPH_WAYS][CELL_ROW_BYTES * CH_H];
+static uint32_t glyphTick = 0;
+static uint32_t glyphHits = 0;
+static uint32_t glyphMisses = 0;
+static volatile bool renderScheduled = false;
+static volatile bool cursorToggle = false;
+static uint8_t blinkFrames = 0;
 #define NONE 0
 #define ES   1
 #define CSI  2
@@ -116,8 +182,10 @@ const uint8_t *currentTextTable;
 static const uint8_t defaultMode = 0b00001000;
 static const uint16_t defaultModeEx = 0b0000000001000000;
 static const ATTR defaultAttr = {0b00000000};
-static const COLOR defaultColor = {(clBlack << 4) | clWhite}; // back, fore
+static const COLOR defaultColor = {(clBlack << 8) | clWhite}; // back, fore
 uint8_t escMode = NONE;         // esc mode indicator
+static uint32_t utf8Cp = 0;     // code point being assembled by write()
+static uint8_t utf8Need = 0;    // continuation bytes still expected
 bool isShowCursor = false;     // is the cursor shown in last call?
 bool canShowCursor = true;    // can the cursor be shown?
 bool hasParam = false;         // <ESC> [ has parameters
@@ -142,26 +210,85 @@ COLOR bColor ;
 
 int16_t nVals = 0;
 int16_t vals[10] = {0};
-static repeating_timer_t cursor_timer;
-
+static repeating_timer_t frame_timer;
 
-bool dispCursor(repeating_timer_t *rt) ;  
+// virtual consoles: the globals above hold the console being written, the
+// others are parked here. Only the shown console has dirty bits, pending
+// scrolls and a cursor, output to any other one just updates its cells
+#define VT_MAX_CONSOLES  8
+typedef struct {
+    uint8_t *screen;
+    uint8_t *attrib;
+    uint16_t *colors;
+    uint8_t tabs[SC_W];
+    uint16_t top, bottom;
+    int16_t xp, yp, bxp, byp;
+    ATTR attr, battr;
+    COLOR color, bcolor;
+    MODE mode;
+    MODE_EX modeEx;
+    uint8_t escMode, utf8Need;
+    uint32_t utf8Cp;
+    bool hasParam, isDECPrivateMode, canShowCursor;
+    int16_t nVals;
+    int16_t vals[10];
+} VTCON;
+static VTCON cons[VT_MAX_CONSOLES];
+static uint8_t nCons = 1;
+// cells of one console: chars, attributes, then the 16 bit colors
+#define CELL_BYTES (4 * SCSIZE)
+static uint8_t con = 0;               // console being written
+static uint8_t shownCon = 0;          // console on the display
+static bool offscreen = false;        // con != shownCon
+// keeps the cell buffers of consoles 1.. alive
+MP_REGISTER_ROOT_POINTER(mp_obj_t vtterminal_consoles[VT_MAX_CONSOLES]);
+
+// alternate screen (DECSET 47/1047/1049): while it is active the main cells
+// and margins of a console are parked in a heap block. If the console is
+// shown and the heap allows, the framebuffer and its dirty bits are kept as
+// well, so leaving is a memcpy instead of a redraw
+#define ALT_BYTES  (CELL_BYTES + 2)
+MP_REGISTER_ROOT_POINTER(void *vtterminal_altCells[VT_MAX_CONSOLES]);
+MP_REGISTER_ROOT_POINTER(void *vtterminal_altFb);
+static uint64_t altDirty[SC_H];
+static int8_t altFbCon = -1;          // console the framebuffer snapshot belongs to
+
+#define VT_FRAME_MS      25    // dirty cells are rasterized at most once per frame
+#define VT_BLINK_FRAMES  10    // cursor blink period in frames (250ms)
+
+bool frameTick(repeating_timer_t *rt) ;  
 
 
 
 //static void scroll_framebuffer(uint8_t *fb,  int scroll_y1, int scroll_y2, int n, uint8_t bg_color);
 static void fill_rect_4bpp(uint8_t *fb,  int x, int y, int w, int h, uint8_t color);
-static void drawTxt6x8(uint8_t *fb,uint8_t c,int x0,int y0, uint8_t color);
+static void fill_rect(uint8_t *fb,  int x, int y, int w, int h, uint8_t color);
+static void drawTxt6x8(uint8_t *fb,const uint8_t *table,uint8_t c,int x0,int y0, uint8_t color);
 static void setpixel(uint8_t *fb,int32_t x, int32_t y,uint8_t color);
+static void drawCell(uint16_t x, uint16_t y, uint8_t c, uint8_t attr, uint16_t color);
+static void fillColors(uint16_t *p, uint16_t value, uint16_t n);
 static void sc_updateChar(uint16_t x, uint16_t y);
+static void historyAppend(uint16_t ln);
+static void historyClear(void);
+static void renderView(void);
 static  void drawCursor(uint16_t x, uint16_t y); 
-static void sc_updateLine(uint16_t ln); 
+static void sc_render(void);
+static void markDirty(uint16_t x, uint16_t y);
+static void markLineDirty(uint16_t ln);
+static void markDirtyRange(uint16_t idx, uint16_t n);
+static void moveLines(uint16_t dst, uint16_t src, uint16_t n);
+static void clearLines(uint16_t ln, uint16_t n);
+static void queueScroll(uint16_t top, uint16_t bottom, int16_t n);
+static void applyPendingScroll(void);
 static void setCursorToHome(void);
 static void initCursorAndAttribute(void);
 static void scroll(void);
 static void clearParams(uint8_t m);
 static void saveCursor(void);
 static void restoreCursor(void);
+static void enterAltScreen(bool save);
+static void leaveAltScreen(bool restore);
+static void dropAltScreen(void);
 static void keypadApplicationMode(void);
 static void keypadNumericMode(void);
 static void vindex(int16_t v);
@@ -201,41 +328,172 @@ static void screenAlignmentDisplay(void);
 static void setG0charset(char c);
 static void setG1charset(char c);
 static void unknownSequence(uint8_t m, char c) ;
+static void setViewOffset(int32_t off);
 static void cursorForward(int16_t v);
 static void cursorBackward(int16_t v);
+static uint8_t consoleArg(mp_obj_t n_obj);
 
 static void setpixel(uint8_t *fb,int32_t x, int32_t y,uint8_t color){
-    uint8_t *pixel = &((uint8_t *)fb)[(x + (SC_PIXEL_WIDTH*y))>>1];
-  
-    if (x&0x01) {
-      *pixel = ((uint8_t)color & 0x0f) | (*pixel & 0xf0);
-    } else {
-      *pixel = ((uint8_t)color << 4) | (*pixel & 0x0f);
+    uint8_t *pixel = &fb[y * fbRowBytes + ((x * fbBpp) >> 3)];
+    switch (fbBpp) {
+      case 4:
+        if (x&0x01) {
+          *pixel = ((uint8_t)color & 0x0f) | (*pixel & 0xf0);
+        } else {
+          *pixel = ((uint8_t)color << 4) | (*pixel & 0x0f);
+        }
+        break;
+      case 8:
+        *pixel = color;
+        break;
+      case 2: {
+        uint8_t shift = (x & 3) << 1;
+        *pixel = (*pixel & ~(0x03 << shift)) | ((color & 0x03) << shift);
+        break;
+      }
+      default: {
+        uint8_t bit = 1 << (x & 7);
+        *pixel = (color & 1) ? (*pixel | bit) : (*pixel & ~bit);
+        break;
+      }
     }
   }
+
+// pixel values for a cell's fore and back color index in the current format,
+// on GS2/MONO a color that lands on its background's level is pushed to the
+// opposite end so text stays readable
+static void pixelColors(uint8_t *fore, uint8_t *back) {
+    if (fbBpp >= 4) return;
+    uint8_t f, b, top;
+    if (fbBpp == 2) {
+        f = gs2Level[*fore & 0x0f];
+        b = gs2Level[*back & 0x0f];
+        top = 3;
+    } else {
+        f = (*fore & 0x0f) != clBlack;
+        b = (*back & 0x0f) != clBlack;
+        top = 1;
+    }
+    if (f == b && *fore != *back)
+        f = (b > top / 2) ? 0 : top;
+    *fore = f;
+    *back = b;
+}
+
+static uint8_t cubeLevel(int16_t v) {
+    if (v < 48) return 0;
+    if (v < 115) return 1;
+    if (v > 255) v = 255;
+    return (v - 35) / 40;
+}
+
+static void fillColors(uint16_t *p, uint16_t value, uint16_t n) {
+    while (n--)
+        *p++ = value;
+}
 static void sc_updateChar(uint16_t x, uint16_t y) {
     uint16_t idx = SC_W * y + x;
-    uint8_t c    = screen[idx];        
+    drawCell(x, y, screen[idx], attrib[idx], colors[idx]);
+}
+
+// find the rendered cell for key, on a miss the least recently used entry of
+// its set is claimed and *cell points to where the new rendering goes
+static bool glyphLookup(uint32_t key, uint8_t **cell) {
+    uint8_t set = (key ^ (key >> 6) ^ (key >> 11)) & (GLYPH_SETS - 1);
+    uint8_t victim = 0;
+    glyphTick++;
+    for (uint8_t w = 0; w < GLYPH_WAYS; w++) {
+        if (glyphKey[set][w] == key) {
+            glyphUsed[set][w] = glyphTick;
+            glyphHits++;
+            *cell = glyphCell[set][w];
+            return true;
+        }
+        if (glyphUsed[set][w] < glyphUsed[set][victim])
+            victim = w;
+    }
+    glyphKey[set][victim] = key;
+    glyphUsed[set][victim] = glyphTick;
+    glyphMisses++;
+    *cell = glyphCell[set][victim];
+    return false;
+}
+
+static void drawCell(uint16_t x, uint16_t y, uint8_t c, uint8_t attr, uint16_t color) {
     ATTR a;
     COLOR l;
-    a.value = attrib[idx];             
-    l.value = colors[idx];             
-    uint8_t fore = l.Color.Foreground | (a.Bits.Blink << 3);
-    uint8_t back = l.Color.Background | (a.Bits.Blink << 3);
+    a.value = attr;
+    l.value = color;
+    uint8_t fore = l.Color.Foreground;
+    uint8_t back = l.Color.Background;
+    if (a.Bits.Blink) {
+        // blink is shown as the bright variant of the 8 basic colors
+        if (fore < 16) fore |= 0x08;
+        if (back < 16) back |= 0x08;
+    }
     if (a.Bits.Reverse){
         uint8_t temp = fore; fore = back; back = temp;
     } 
     if (mode_ex.Flgs.ScreenReverse){
         uint8_t temp = fore; fore = back; back = temp;
     } 
+    VT_STAT(glyphs, 1);
+    if (c < 16) c = 32; // drawn as a blank anyway
     uint16_t xx = x * CH_W;
     uint16_t yy = y * CH_H;
+    const uint8_t *table = a.Bits.G1 ? G1TABLE : G0TABLE;
+    if (fbBpp != 4) {
+        // only 4bpp cells start on a byte, the other formats draw directly
+        pixelColors(&fore, &back);
+        fill_rect(fb, xx, yy, CH_W, CH_H, back);
+        drawTxt6x8(fb,table,c,xx,yy, fore);
+        if (a.Bits.Bold)
+            drawTxt6x8(fb,table,c,xx+1,yy, fore);
+        return;
+    }
+    uint32_t key = GLYPH_VALID | c | (fore << 8) | (back << 12) | (a.Bits.Bold << 16) | (a.Bits.G1 << 17);
+    uint8_t *dst = fb + yy * fbRowBytes + (xx >> 1);
+    uint8_t *cell;
+    if (glyphLookup(key, &cell)) {
+        // a hit is 8 row copies
+        for (uint8_t r = 0; r < CH_H; r++, dst += fbRowBytes, cell += CELL_ROW_BYTES)
+            memcpy(dst, cell, CELL_ROW_BYTES);
+        return;
+    }
     fill_rect_4bpp(fb, xx, yy, CH_W, CH_H, back);
-    drawTxt6x8(fb,c,xx,yy, fore);
+    drawTxt6x8(fb,table,c,xx,yy, fore);
     if (a.Bits.Bold){
-        drawTxt6x8(fb,c,xx+1,yy, fore);
+        drawTxt6x8(fb,table,c,xx+1,yy, fore);
     }
-        
+    for (uint8_t r = 0; r < CH_H; r++, dst += fbRowBytes, cell += CELL_ROW_BYTES)
+        memcpy(cell, dst, CELL_ROW_BYTES);
+}
+
+static void markDirty(uint16_t x, uint16_t y) {
+    if (offscreen) return;
+    dirty[y] |= ((uint64_t)1) << x;
+    needRender = true;
+}
+
+static void markLineDirty(uint16_t ln) {
+    if (offscreen) return;
+    dirty[ln] = ALL_COLS;
+    needRender = true;
+}
+
+// mark n cells starting at linear index idx, the span may cross lines
+static void markDirtyRange(uint16_t idx, uint16_t n) {
+    if (offscreen) return;
+    while (n) {
+        uint16_t y = idx / SC_W;
+        uint16_t x = idx % SC_W;
+        uint16_t cnt = SC_W - x;
+        if (cnt > n) cnt = n;
+        dirty[y] |= ((cnt == SC_W) ? ALL_COLS : ((((uint64_t)1) << cnt) - 1)) << x;
+        idx += cnt;
+        n -= cnt;
+    }
+    needRender = true;
 }
 
     
@@ -244,32 +502,169 @@ static void sc_updateChar(uint16_t x, uint16_t y) {
 static  void drawCursor(uint16_t x, uint16_t y) {
     uint16_t xx = x * CH_W;
     uint16_t yy = y * CH_H;
-    fill_rect_4bpp(fb, xx, yy, CH_W, CH_H, clWhite);
+    uint8_t fore = clWhite, back = clBlack;
+    pixelColors(&fore, &back);
+    fill_rect(fb, xx, yy, CH_W, CH_H, fore);
 }
 
-bool dispCursor(repeating_timer_t *rt) {
-    if (escMode != NONE)
-      return true;
-    //sc_updateChar(p_XP, p_YP);  
-    if  (canShowCursor){
-
-        isShowCursor = !isShowCursor;
-        if (isShowCursor){
-            drawCursor(XP, YP);
-        }else{
-            sc_updateChar(p_XP, p_YP);
+// rasterize every dirty cell, then put the cursor back on top if it was covered
+static void sc_render(void) {
+    bool cursorCovered = false;
+    applyPendingScroll();
+    if (cursorToggle) {
+        cursorToggle = false;
+        if (canShowCursor && !viewOffset) {
+            isShowCursor = !isShowCursor;
+            if (isShowCursor) {
+                p_XP = XP;
+                p_YP = YP;
+                cursorCovered = true;
+            } else {
+                markDirty(p_XP, p_YP);
+            }
         }
-        p_XP = XP;
-        p_YP = YP;
     }
-    return true;
+    needRender = false;
+    if (isShowCursor && (dirty[p_YP] & (((uint64_t)1) << p_XP)))
+        cursorCovered = true;
+    // while the history is shown, lines under the view keep their dirty bits
+    uint16_t last = viewOffset ? viewTop : SC_H;
+    for (uint16_t y = 0; y < last; y++) {
+        uint64_t bits = dirty[y];
+        if (!bits) continue;
+        dirty[y] = 0;
+        while (bits) {
+            sc_updateChar(__builtin_ctzll(bits), y);
+            bits &= bits - 1;
+        }
+    }
+    if (viewOffset && viewDirty) {
+        viewDirty = false;
+        renderView();
+    } else if (viewOffset) {
+        // output to screen lines that the view shows further down
+        for (uint16_t y = viewTop; y + viewOffset < SC_H; y++) {
+            uint64_t bits = dirty[y];
+            if (!bits) continue;
+            dirty[y] = 0;
+            while (bits) {
+                uint16_t x = __builtin_ctzll(bits);
+                uint16_t idx = y * SC_W + x;
+                drawCell(x, y + viewOffset, screen[idx], attrib[idx], colors[idx]);
+                bits &= bits - 1;
+            }
+        }
+    }
+    if (cursorCovered && isShowCursor && canShowCursor)
+        drawCursor(p_XP, p_YP);
+}
+
+static void saveConsole(VTCON *c) {
+    c->screen = screen;
+    c->attrib = attrib;
+    c->colors = colors;
+    memcpy(c->tabs, tabs, SC_W);
+    c->top = M_TOP;
+    c->bottom = M_BOTTOM;
+    c->xp = XP;
+    c->yp = YP;
+    c->bxp = b_XP;
+    c->byp = b_YP;
+    c->attr = cAttr;
+    c->battr = bAttr;
+    c->color = cColor;
+    c->bcolor = bColor;
+    c->mode = mode;
+    c->modeEx = mode_ex;
+    c->escMode = escMode;
+    c->utf8Need = utf8Need;
+    c->utf8Cp = utf8Cp;
+    c->hasParam = hasParam;
+    c->isDECPrivateMode = isDECPrivateMode;
+    c->canShowCursor = canShowCursor;
+    c->nVals = nVals;
+    memcpy(c->vals, vals, sizeof(vals));
+}
+
+static void loadConsole(const VTCON *c) {
+    screen = c->screen;
+    attrib = c->attrib;
+    colors = c->colors;
+    memcpy(tabs, c->tabs, SC_W);
+    M_TOP = c->top;
+    M_BOTTOM = c->bottom;
+    XP = c->xp;
+    YP = c->yp;
+    b_XP = c->bxp;
+    b_YP = c->byp;
+    cAttr = c->attr;
+    bAttr = c->battr;
+    cColor = c->color;
+    bColor = c->bcolor;
+    mode = c->mode;
+    mode_ex = c->modeEx;
+    escMode = c->escMode;
+    utf8Need = c->utf8Need;
+    utf8Cp = c->utf8Cp;
+    hasParam = c->hasParam;
+    isDECPrivateMode = c->isDECPrivateMode;
+    canShowCursor = c->canShowCursor;
+    nVals = c->nVals;
+    memcpy(vals, c->vals, sizeof(vals));
 }
 
-static void sc_updateLine(uint16_t ln) {
-    for (uint32_t i=0;i<SC_W;i++){
-       sc_updateChar(i, ln);
+// route the parser to console n
+static void selectConsole(uint8_t n) {
+    if (n == con) return;
+    saveConsole(&cons[con]);
+    loadConsole(&cons[n]);
+    con = n;
+    offscreen = (con != shownCon);
+}
+
+// put console n on the display, it is rendered once at the next frame
+static void showConsole(uint8_t n) {
+    if (n == shownCon) return;
+    shownCon = n;
+    offscreen = (con != shownCon);
+    scrollPending = 0;
+    viewOffset = 0;
+    viewDirty = false;
+    isShowCursor = false;
+    for (uint16_t y = 0; y < SC_H; y++)
+        dirty[y] = ALL_COLS;
+    needRender = true;
+}
+
+static mp_obj_t vt_flush(size_t n_args, const mp_obj_t *args) {
+    renderScheduled = false;
+    if (fb != NULL) {
+        // may run between two writes to a background console
+        uint8_t prev = con;
+        selectConsole(shownCon);
+        sc_render();
+        selectConsole(prev);
+    }
+    return mp_const_none;
+}
+static MP_DEFINE_CONST_FUN_OBJ_VAR_BETWEEN(vt_flush_obj, 0, 1, vt_flush);
+
+// frame timer, runs in IRQ context: only hands the rendering over to the VM
+bool frameTick(repeating_timer_t *rt) {
+    if (++blinkFrames >= VT_BLINK_FRAMES) {
+        blinkFrames = 0;
+        // the cursor belongs to the shown console, the globals may hold a background one
+        bool idle = offscreen ? (cons[shownCon].escMode == NONE && cons[shownCon].canShowCursor)
+                              : (escMode == NONE && canShowCursor);
+        if (idle)
+            cursorToggle = true;
     }
+    if ((needRender || cursorToggle) && !renderScheduled) {
+        renderScheduled = mp_sched_schedule(MP_OBJ_FROM_PTR(&vt_flush_obj), mp_const_none);
+    }
+    return true;
 }
+
     
 static void setCursorToHome(void) {
     XP = 0;
@@ -374,30 +769,204 @@ static void scroll(void) {
 }
 */
 
+// move n text lines from src to dst together with their dirty bits, the
+// rendered pixels follow through queueScroll(), so nothing is rasterized again
+static void moveLines(uint16_t dst, uint16_t src, uint16_t n) {
+    if (n == 0 || dst == src) return;
+    memmove(&screen[dst * SC_W], &screen[src * SC_W], n * SC_W);
+    memmove(&attrib[dst * SC_W], &attrib[src * SC_W], n * SC_W);
+    memmove(&colors[dst * SC_W], &colors[src * SC_W], n * SC_W * sizeof(colors[0]));
+    if (!offscreen)
+        memmove(&dirty[dst], &dirty[src], n * sizeof(dirty[0]));
+}
+
+// move the 8 pixel bands of lines top..bottom up by n lines (down if n < 0)
+static void shiftPixels(uint16_t top, uint16_t bottom, int16_t n) {
+    int16_t height = bottom - top + 1;
+    int16_t k = (n < 0) ? -n : n;
+    if (k == 0 || k >= height) return; // every line in the band is dirty anyway
+    if (n > 0)
+        memmove(fb + top * fbLineBytes, fb + (top + k) * fbLineBytes, (height - k) * fbLineBytes);
+    else
+        memmove(fb + (top + k) * fbLineBytes, fb + top * fbLineBytes, (height - k) * fbLineBytes);
+    VT_STAT(bandMoves, 1);
+    // a visible cursor block travels with its line
+    if (isShowCursor && p_YP >= top && p_YP <= bottom) {
+        int16_t y = p_YP - n;
+        if (y >= top && y <= bottom)
+            p_YP = y;
+    }
+}
+
+static void applyPendingScroll(void) {
+    if (scrollPending != 0) {
+        if (viewOffset) {
+            // the framebuffer holds the history view, redraw instead
+            for (uint16_t y = scrollTop; y <= scrollBottom; y++)
+                markLineDirty(y);
+        } else {
+            shiftPixels(scrollTop, scrollBottom, scrollPending);
+        }
+        scrollPending = 0;
+    }
+}
+
+// record a scroll of lines top..bottom, the cells have already been moved
+static void queueScroll(uint16_t top, uint16_t bottom, int16_t n) {
+    if (offscreen) return;
+    if (scrollPending != 0 && (top != scrollTop || bottom != scrollBottom))
+        applyPendingScroll();
+    VT_STAT(lines, (n < 0) ? -n : n);
+    scrollTop = top;
+    scrollBottom = bottom;
+    scrollPending += n;
+    if (scrollPending > SC_H) scrollPending = SC_H;
+    if (scrollPending < -SC_H) scrollPending = -SC_H;
+}
+
+// blank n lines with the default attributes, they are the only ones to render
+static void clearLines(uint16_t ln, uint16_t n) {
+    memset(&screen[ln * SC_W], 0x00, n * SC_W);
+    memset(&attrib[ln * SC_W], defaultAttr.value, n * SC_W);
+    fillColors(&colors[ln * SC_W], defaultColor.value, n * SC_W);
+    for (uint16_t y = ln; y < ln + n; y++)
+        markLineDirty(y);
+}
+
 void scroll() {
   if (mode.Flgs.CrLf) XP = 0;
   YP++;
   if (YP > M_BOTTOM) {
-    uint16_t n = SCSIZE - SC_W - ((M_TOP + MAX_SC_Y - M_BOTTOM) * SC_W);
-    uint16_t idx = SC_W * M_BOTTOM;
-    uint16_t idx2;
-    uint16_t idx3 = M_TOP * SC_W;
-    memmove(&screen[idx3], &screen[idx3 + SC_W], n);
-    memmove(&attrib[idx3], &attrib[idx3 + SC_W], n);
-    memmove(&colors[idx3], &colors[idx3 + SC_W], n);
-    for (uint8_t x = 0; x < SC_W; x++) {
-      idx2 = idx + x;
-      screen[idx2] = 0;
-      attrib[idx2] = defaultAttr.value;
-      colors[idx2] = defaultColor.value;
-    }
-    for (uint8_t y = M_TOP; y <= M_BOTTOM; y++)
-      sc_updateLine(y);
+    // like xterm, the alternate screen (the editor) adds nothing to the history
+    if (hist && con == 0 && M_BOTTOM == MAX_SC_Y && MP_STATE_VM(vtterminal_altCells)[0] == NULL)
+      historyAppend(M_TOP);
+    moveLines(M_TOP, M_TOP + 1, M_BOTTOM - M_TOP);
+    clearLines(M_BOTTOM, 1);
+    queueScroll(M_TOP, M_BOTTOM, 1);
     YP = M_BOTTOM;
   }
 }
 
 
+static uint8_t histByte(uint32_t off) {
+    return hist[off % histSize];
+}
+
+static uint32_t histRecordSize(uint32_t off) {
+    uint8_t len = histByte(off);
+    return 4 + len + 4 * histByte(off + 1 + len);
+}
+
+// copy a line into the ring, dropping the oldest lines to make room
+static void historyAppend(uint16_t ln) {
+    static uint8_t rec[HIST_REC_MAX];
+    const uint8_t *s = &screen[ln * SC_W];
+    const uint8_t *a = &attrib[ln * SC_W];
+    const uint16_t *l = &colors[ln * SC_W];
+    uint8_t len = SC_W;
+    while (len && (s[len - 1] == 0 || s[len - 1] == ' '))
+        len--;
+    uint32_t n = 0;
+    rec[n++] = len;
+    memcpy(&rec[n], s, len);
+    n += len;
+    uint32_t runsAt = n++;
+    uint8_t runs = 0;
+    for (uint16_t x = 0; x < SC_W; runs++) {
+        uint16_t e = x + 1;
+        while (e < SC_W && a[e] == a[x] && l[e] == l[x])
+            e++;
+        rec[n++] = e - x;
+        rec[n++] = a[x];
+        rec[n++] = l[x] & 0xff;
+        rec[n++] = l[x] >> 8;
+        x = e;
+    }
+    rec[runsAt] = runs;
+    n += 2;
+    rec[n - 2] = n & 0xff;
+    rec[n - 1] = n >> 8;
+
+    bool evicted = false;
+    while (histSize - histUsed < n) {
+        evicted = true;
+        uint32_t sz = histRecordSize(histHead);
+        histHead = (histHead + sz) % histSize;
+        histUsed -= sz;
+        histLines--;
+    }
+    uint32_t first = histSize - histTail;
+    if (first > n) first = n;
+    memcpy(hist + histTail, rec, first);
+    memcpy(hist, rec + first, n - first);
+    histTail = (histTail + n) % histSize;
+    histUsed += n;
+    histLines++;
+    // keep a view that is scrolled back on the same lines, the oldest may be
+    // gone, then the page it shows has to be drawn again
+    if (viewOffset && viewOffset < histLines)
+        viewOffset++;
+    if (viewOffset > histLines)
+        viewOffset = histLines;
+    if (viewOffset && evicted) {
+        viewDirty = true;
+        needRender = true;
+    }
+}
+
+static void historyClear(void) {
+    histHead = histTail = histUsed = histLines = 0;
+}
+
+// start of the record h lines back, 1 is the newest
+static uint32_t historyFind(uint32_t h) {
+    uint32_t off = histTail;
+    while (h--) {
+        uint32_t sz = histByte(off + histSize - 2) | (histByte(off + histSize - 1) << 8);
+        off = (off + histSize - sz) % histSize;
+    }
+    return off;
+}
+
+// unpack the record at off, returns the start of the next one
+static uint32_t historyLine(uint32_t off, uint8_t *s, uint8_t *a, uint16_t *l) {
+    uint8_t len = histByte(off);
+    for (uint16_t x = 0; x < SC_W; x++)
+        s[x] = (x < len) ? histByte(off + 1 + x) : 0;
+    uint32_t p = off + 1 + len;
+    uint8_t runs = histByte(p++);
+    uint16_t x = 0;
+    while (runs--) {
+        uint8_t cnt = histByte(p);
+        memset(&a[x], histByte(p + 1), cnt);
+        fillColors(&l[x], histByte(p + 2) | (histByte(p + 3) << 8), cnt);
+        x += cnt;
+        p += 4;
+    }
+    return (p + 2) % histSize;
+}
+
+// draw the scrolled back page, only the lines under the view are touched
+static void renderView(void) {
+    static uint8_t s[SC_W], a[SC_W];
+    static uint16_t l[SC_W];
+    uint32_t off = historyFind(viewOffset);
+    for (uint16_t y = viewTop; y < SC_H; y++) {
+        int32_t v = (int32_t)y - (int32_t)viewOffset;
+        if (v < viewTop) {
+            off = historyLine(off, s, a, l);
+            for (uint16_t x = 0; x < SC_W; x++)
+                drawCell(x, y, s[x], a[x], l[x]);
+        } else {
+            for (uint16_t x = 0; x < SC_W; x++) {
+                uint16_t idx = v * SC_W + x;
+                drawCell(x, y, screen[idx], attrib[idx], colors[idx]);
+            }
+            dirty[v] = 0;
+        }
+    }
+}
+
 static void clearParams(uint8_t m) {
     escMode = m;
     isDECPrivateMode = false;
@@ -674,12 +1243,10 @@ static mp_obj_t vt_printChar(mp_obj_t value_obj) {
     }
     if (c== 0x0e){//using g1
         mode.Flgs.g0g1 = 1;
-        currentTextTable=G1TABLE;
         return mp_const_none;
     }
     if (c==0x0f){//using g0
         mode.Flgs.g0g1 = 0;
-        currentTextTable=G0TABLE;
         return mp_const_none;
     }
     // (BS)
@@ -689,7 +1256,7 @@ static mp_obj_t vt_printChar(mp_obj_t value_obj) {
       screen[idx] = 0;
       attrib[idx] = 0;
       colors[idx] = cColor.value;
-      sc_updateChar(XP, YP);
+      markDirty(XP, YP);
       return mp_const_none;
     }
 
@@ -713,6 +1280,9 @@ static mp_obj_t vt_printChar(mp_obj_t value_obj) {
     // normal char
     if (XP < SC_W) {
       uint16_t idx = YP * SC_W + XP;
+      ATTR a;
+      a.value = cAttr.value;
+      a.Bits.G1 = mode.Flgs.g0g1;
       if (mode_ex.Flgs.InsertMode){
         // insert
         for (int16_t i = (YP+1) * SC_W - 1; i > idx; i--) {
@@ -721,16 +1291,14 @@ static mp_obj_t vt_printChar(mp_obj_t value_obj) {
           colors[i] = colors[i - 1];
         }
         screen[idx] = c;
-        attrib[idx] = cAttr.value;
+        attrib[idx] = a.value;
         colors[idx] = cColor.value;
-        for (int16_t i = XP; i < SC_W; i++) {
-          sc_updateChar(i, YP);
-        }
+        markDirtyRange(idx, SC_W - XP);
       }else{
         screen[idx] = c;
-        attrib[idx] = cAttr.value;
+        attrib[idx] = a.value;
         colors[idx] = cColor.value;
-        sc_updateChar(XP, YP);
+        markDirty(XP, YP);
       }
       
     }
@@ -757,6 +1325,50 @@ static mp_obj_t vt_printChar(mp_obj_t value_obj) {
 
 static MP_DEFINE_CONST_FUN_OBJ_1(vt_printChar_obj, vt_printChar);  
 
+// one byte of UTF-8 output, complete code points go to printChar. A byte that
+// cannot be part of a sequence is printed as is, a broken sequence is dropped
+static void putByte(uint8_t b) {
+    if (utf8Need) {
+        if ((b & 0xc0) == 0x80) {
+            utf8Cp = (utf8Cp << 6) | (b & 0x3f);
+            if (--utf8Need == 0)
+                vt_printChar(MP_OBJ_NEW_SMALL_INT(utf8Cp));
+            return;
+        }
+        utf8Need = 0;
+    }
+    if (b < 0x80 || (b & 0xc0) == 0x80 || b >= 0xf8) {
+        if (b != 0x07) // no bell to ring
+            vt_printChar(MP_OBJ_NEW_SMALL_INT(b));
+    } else if (b >= 0xf0) {
+        utf8Cp = b & 0x07;
+        utf8Need = 3;
+    } else if (b >= 0xe0) {
+        utf8Cp = b & 0x0f;
+        utf8Need = 2;
+    } else {
+        utf8Cp = b & 0x1f;
+        utf8Need = 1;
+    }
+}
+
+// write(buf, [console]): feed bytes, bytearray, memoryview or str to the
+// terminal (or to console n) without building a str per call, a sequence
+// split between two writes is completed by the next one. Returns len(buf)
+static mp_obj_t vt_write(size_t n_args, const mp_obj_t *args) {
+    mp_buffer_info_t buf_info;
+    mp_get_buffer_raise(args[0], &buf_info, MP_BUFFER_READ);
+    uint8_t prev = con;
+    if (n_args > 1)
+        selectConsole(consoleArg(args[1]));
+    const uint8_t *p = (const uint8_t *)buf_info.buf;
+    for (size_t i = 0; i < buf_info.len; i++)
+        putByte(p[i]);
+    selectConsole(prev);
+    return mp_obj_new_int(buf_info.len);
+}
+static MP_DEFINE_CONST_FUN_OBJ_VAR_BETWEEN(vt_write_obj, 1, 2, vt_write);
+
 
 
 
@@ -776,6 +1388,75 @@ static void restoreCursor(void){
     cColor.value = bColor.value;
 }
   
+static void enterAltScreen(bool save) {
+    if (MP_STATE_VM(vtterminal_altCells)[con] != NULL) return;
+    uint8_t *cells = m_new_maybe(uint8_t, ALT_BYTES);
+    if (cells == NULL) return; // no room, stay on the main screen
+    if (save) saveCursor();
+    memcpy(cells, screen, SCSIZE);
+    memcpy(cells + SCSIZE, attrib, SCSIZE);
+    memcpy(cells + 2 * SCSIZE, colors, 2 * SCSIZE);
+    cells[CELL_BYTES] = M_TOP;
+    cells[CELL_BYTES + 1] = M_BOTTOM;
+    MP_STATE_VM(vtterminal_altCells)[con] = cells;
+    if (!offscreen && !viewOffset && MP_STATE_VM(vtterminal_altFb) == NULL) {
+        uint8_t *snap = m_new_maybe(uint8_t, fbSize);
+        if (snap != NULL) {
+            applyPendingScroll();
+            memcpy(snap, fb, fbSize);
+            memcpy(altDirty, dirty, sizeof(dirty));
+            // the snapshot may hold the cursor block, redraw that cell later
+            if (isShowCursor)
+                altDirty[p_YP] |= ((uint64_t)1) << p_XP;
+            MP_STATE_VM(vtterminal_altFb) = snap;
+            altFbCon = con;
+        }
+    }
+    eraseInDisplay(2);
+}
+
+static void leaveAltScreen(bool restore) {
+    uint8_t *cells = MP_STATE_VM(vtterminal_altCells)[con];
+    if (cells == NULL) return;
+    memcpy(screen, cells, SCSIZE);
+    memcpy(attrib, cells + SCSIZE, SCSIZE);
+    memcpy(colors, cells + 2 * SCSIZE, 2 * SCSIZE);
+    M_TOP = cells[CELL_BYTES];
+    M_BOTTOM = cells[CELL_BYTES + 1];
+    m_del(uint8_t, cells, ALT_BYTES);
+    MP_STATE_VM(vtterminal_altCells)[con] = NULL;
+    uint8_t *snap = MP_STATE_VM(vtterminal_altFb);
+    if (snap != NULL && altFbCon == con && !offscreen && !viewOffset) {
+        memcpy(fb, snap, fbSize);
+        memcpy(dirty, altDirty, sizeof(dirty));
+        scrollPending = 0;
+        isShowCursor = false;
+        needRender = true;
+    } else {
+        for (uint16_t y = 0; y < SC_H; y++)
+            markLineDirty(y);
+    }
+    if (snap != NULL && altFbCon == con) {
+        m_del(uint8_t, snap, fbSize);
+        MP_STATE_VM(vtterminal_altFb) = NULL;
+        altFbCon = -1;
+    }
+    if (restore) restoreCursor();
+}
+
+// forget the alternate screen of the current console without restoring it
+static void dropAltScreen(void) {
+    if (MP_STATE_VM(vtterminal_altCells)[con] != NULL) {
+        m_del(uint8_t, MP_STATE_VM(vtterminal_altCells)[con], ALT_BYTES);
+        MP_STATE_VM(vtterminal_altCells)[con] = NULL;
+    }
+    if (MP_STATE_VM(vtterminal_altFb) != NULL && altFbCon == con) {
+        m_del(uint8_t, MP_STATE_VM(vtterminal_altFb), fbSize);
+        MP_STATE_VM(vtterminal_altFb) = NULL;
+        altFbCon = -1;
+    }
+}
+
   // DECKPAM (Keypad Application Mode): 
 static void keypadApplicationMode(void) {
     return;
@@ -818,37 +1499,11 @@ static void reverseIndex(int16_t v) {
         if (lines_to_scroll > scroll_region_height)
             lines_to_scroll = scroll_region_height;
 
-        int lines_to_move = scroll_region_height - lines_to_scroll;
-
-        if (lines_to_move > 0) {
-            int n = SC_W * lines_to_move;
-            int dst = SC_W * (M_TOP + lines_to_scroll);
-            int src = SC_W * M_TOP;
-            
-            if (src >= 0 && dst >= 0 && 
-                src + n <= SC_W * SC_H && 
-                dst + n <= SC_W * SC_H) {
-                memmove(&screen[dst], &screen[src], n);
-                memmove(&attrib[dst], &attrib[src], n);
-                memmove(&colors[dst], &colors[src], n);
-            }
-        }
-        int top_idx = SC_W * M_TOP;
-        int fill_len = SC_W * lines_to_scroll;
-
-        if (top_idx >= 0 && top_idx + fill_len <= SC_W * SC_H) {
-            memset(&screen[top_idx], 0x00, fill_len);
-            memset(&attrib[top_idx], defaultAttr.value, fill_len);
-            memset(&colors[top_idx], defaultColor.value, fill_len);
-        }
+        moveLines(M_TOP + lines_to_scroll, M_TOP, scroll_region_height - lines_to_scroll);
+        clearLines(M_TOP, lines_to_scroll);
+        queueScroll(M_TOP, M_BOTTOM, -lines_to_scroll);
 
         YP = M_TOP;
-        
-        for (int y = M_TOP; y <= M_BOTTOM; y++) {
-            if (y >= 0 && y < SC_H) {
-                sc_updateLine(y);
-            }
-        }
     } else {
         YP = targetYP;
     }
@@ -862,7 +1517,14 @@ static void identify(void) {
   
   // RIS (Reset To Initial State) リセット
 static void resetToInitialState(void) {
-    fill_rect_4bpp(fb,  0, 0, SC_PIXEL_WIDTH, SC_PIXEL_HEIGHT, defaultColor.Color.Background);
+    dropAltScreen();
+    if (!offscreen) {
+      scrollPending = 0; // the whole screen is cleared and redrawn
+      viewOffset = 0;
+      uint8_t fore = defaultColor.Color.Foreground, back = defaultColor.Color.Background;
+      pixelColors(&fore, &back);
+      fill_rect(fb,  0, 0, SC_PIXEL_WIDTH, SC_PIXEL_HEIGHT, back);
+    }
     initCursorAndAttribute();
     eraseInDisplay(2);
   }
@@ -933,45 +1595,42 @@ static void cursorPosition(uint8_t y, uint8_t x) {
 static void refreshScreen(void) {
 
     for (uint8_t i = 0; i < SC_H; i++){
-        sc_updateLine(i);
+        markLineDirty(i);
     }
 }
   
 
 static void eraseInDisplay(uint8_t m) {
-    uint8_t sl = 0, el = 0;
     uint16_t idx = 0, n = 0;
   
     switch (m) {
       case 0:
 
-        sl = YP;
-        el = MAX_SC_Y;
         idx = YP * SC_W + XP;
         n   = SCSIZE - (YP * SC_W + XP);
         break;
       case 1:
 
-        sl = 0;
-        el = YP;
         idx = 0;
         n = YP * SC_W + XP + 1;
         break;
       case 2:
 
-        sl = 0;
-        el = MAX_SC_Y;
         idx = 0;
         n = SCSIZE;
         break;
     }
   
+    if (m == 3 && con == 0) {
+      // ED 3 (xterm): erase the saved lines
+      setViewOffset(0);
+      historyClear();
+    }
     if (m <= 2) {
       memset(&screen[idx], 0x00, n);
       memset(&attrib[idx], defaultAttr.value, n);
-      memset(&colors[idx], defaultColor.value, n);
-      for (uint8_t i = sl; i <= el; i++)
-        sc_updateLine(i);
+      fillColors(&colors[idx], defaultColor.value, n);
+      markDirtyRange(idx, n);
     }
   }
   
@@ -1001,9 +1660,8 @@ static void eraseInLine(uint8_t m) {
       uint16_t n = elp - slp + 1;
       memset(&screen[slp], 0x00, n);
       memset(&attrib[slp], defaultAttr.value, n);
-      memset(&colors[slp], cColor.value, n);
-      //memset(&colors[slp], defaultColor.value, n);
-      sc_updateLine(YP);
+      fillColors(&colors[slp], cColor.value, n);
+      markDirtyRange(slp, n);
     }
 }
   
@@ -1012,23 +1670,11 @@ static void eraseInLine(uint8_t m) {
 static void insertLine(uint8_t v) {
     int16_t rows = v;
     if (rows == 0) return;
+    if (YP < M_TOP || YP > M_BOTTOM) return; // only inside the scroll region
     if (rows > ((M_BOTTOM + 1) - YP)) rows = (M_BOTTOM + 1) - YP;
-    int16_t idx = SC_W * YP;
-    int16_t n = SC_W * rows;
-    int16_t idx2 = idx + n;
-    int16_t move_rows = (M_BOTTOM + 1) - YP - rows;
-    int16_t n2 = SC_W * move_rows;
-  
-    if (move_rows > 0) {
-      memmove(&screen[idx2], &screen[idx], n2);
-      memmove(&attrib[idx2], &attrib[idx], n2);
-      memmove(&colors[idx2], &colors[idx], n2);
-    }
-    memset(&screen[idx], 0x00, n);
-    memset(&attrib[idx], defaultAttr.value, n);
-    memset(&colors[idx], defaultColor.value, n);
-    for (uint8_t y = YP; y <= M_BOTTOM; y++)
-      sc_updateLine(y);
+    moveLines(YP + rows, YP, (M_BOTTOM + 1) - YP - rows);
+    clearLines(YP, rows);
+    queueScroll(YP, M_BOTTOM, -rows);
   }
   
   // DL (Delete Line): 
@@ -1036,45 +1682,32 @@ static void insertLine(uint8_t v) {
 static  void deleteLine(uint8_t v) {
     int16_t rows = v;
     if (rows == 0) return;
+    if (YP < M_TOP || YP > M_BOTTOM) return; // only inside the scroll region
     if (rows > ((M_BOTTOM + 1) - YP)) rows = (M_BOTTOM + 1) - YP;
-    int16_t idx = SC_W * YP;
-    int16_t n = SC_W * rows;
-    int16_t idx2 = idx + n;
-    int16_t move_rows = (M_BOTTOM + 1) - YP - rows;
-    int16_t n2 = SC_W * move_rows;
-    int16_t idx3 = (M_BOTTOM + 1) * SC_W - n;
-  
-    if (move_rows > 0) {
-      memmove(&screen[idx], &screen[idx2], n2);
-      memmove(&attrib[idx], &attrib[idx2], n2);
-      memmove(&colors[idx], &colors[idx2], n2);
-    }
-    memset(&screen[idx3], 0x00, n);
-    memset(&attrib[idx3], defaultAttr.value, n);
-    memset(&colors[idx3], defaultColor.value, n);
-    for (uint8_t y = YP; y <= M_BOTTOM; y++)
-      sc_updateLine(y);
+    moveLines(YP, YP + rows, (M_BOTTOM + 1) - YP - rows);
+    clearLines((M_BOTTOM + 1) - rows, rows);
+    queueScroll(YP, M_BOTTOM, rows);
   }
   
   // CPR (Cursor Position Report): 
+static void respond(const char *s, uint16_t len) {
+    if (respLen + len > VT_RESP_SIZE) return;
+    for (uint16_t i = 0; i < len; i++)
+        respBuf[(respHead + respLen + i) % VT_RESP_SIZE] = s[i];
+    respLen += len;
+}
+
 static void cursorPositionReport(uint16_t y, uint16_t x) {
     char temp[30];
     int32_t len = sprintf(temp, "\x1b[%d;%dR", SC_H, SC_W);
-    
-    if (outputLen + len <= sizeof(outputBuf)) {
-        memcpy(&(outputBuf[outputLen]), temp, len);
-        outputLen += len;
-    }
+    respond(temp, len);
 }
   
   // DA (Device Attributes): 
 
 static void deviceAttributes(uint8_t m) {
 
-    if (outputLen + 7 <= sizeof(outputBuf)) {
-        memcpy(&(outputBuf[outputLen]), "\e[?1;0c", 7);
-        outputLen += 7;
-      }
+    respond("\e[?1;0c", 7);
   }
   
   // TBC (Tabulation Clear): 
@@ -1142,6 +1775,15 @@ static void decSetMode(int16_t *vals, int16_t nVals) {
           // DECTCEM (Cursor Mode): 
           canShowCursor = true;
           break;
+        case 47:
+        case 1047:
+          // alternate screen
+          enterAltScreen(false);
+          break;
+        case 1049:
+          // alternate screen, saving the cursor as DECSC
+          enterAltScreen(true);
+          break;
         default:
           break;
       }
@@ -1182,7 +1824,14 @@ static void decResetMode(int16_t *vals, int16_t nVals) {
         case 25:
           // DECTCEM (Cursor Mode): 
           canShowCursor = false;
-          sc_updateChar(p_XP, p_YP);//cover the hided character at cursor position
+          markDirty(p_XP, p_YP);//cover the hided character at cursor position
+          break;
+        case 47:
+        case 1047:
+          leaveAltScreen(false);
+          break;
+        case 1049:
+          leaveAltScreen(true);
           break;
         default:
           break;
@@ -1286,7 +1935,10 @@ static void selectGraphicRendition(int16_t *vals, int16_t nVals) {
         case 2:
           // Index Color
           if (v < 256) {
-            if (v < 16) {
+            if (fbBpp == 8) {
+              // the GS8 LUT is the xterm 256 color palette
+              cIdx = v;
+            } else if (v < 16) {
               // 16 color
               cIdx = v;
             } else if (v < 232) {
@@ -1335,6 +1987,13 @@ static void selectGraphicRendition(int16_t *vals, int16_t nVals) {
             b=0;
         }
           cIdx = (b << 2) | (g << 1) | r;
+          if (fbBpp == 8) {
+            // nearest entry of the 6x6x6 cube (levels 0, 95, 135, .. 255)
+            r = cubeLevel(vals[i-2]);
+            g = cubeLevel(vals[i-1]);
+            b = cubeLevel(vals[i-0]);
+            cIdx = 16 + 36 * r + 6 * g + b;
+          }
           if (isFore)
             cColor.Color.Foreground = cIdx;
           else
@@ -1352,11 +2011,7 @@ static void selectGraphicRendition(int16_t *vals, int16_t nVals) {
 static void deviceStatusReport(uint8_t m) {
     switch (m) {
       case 5:
-        if (outputLen + 4 <= sizeof(outputBuf)) {
-          memcpy(&(outputBuf[outputLen]), "\e[0n", 4);
-          outputLen += 4;
-        }
-
+        respond("\e[0n", 4);
         break;
       case 6:
         cursorPositionReport(XP, YP); // CPR (Cursor Position Report)
@@ -1416,9 +2071,9 @@ static  void screenAlignmentDisplay(void) {
     
     memset(screen, 0x45, SCSIZE);
     memset(attrib, defaultAttr.value, SCSIZE);
-    memset(colors, defaultColor.value, SCSIZE);
+    fillColors(colors, defaultColor.value, SCSIZE);
     for (uint8_t y = 0; y < SC_H; y++)
-      sc_updateLine(y);
+      markLineDirty(y);
   }
   
   // "(" G0 Sets Sequence
@@ -1452,7 +2107,7 @@ static void unknownSequence(uint8_t m, char c) {
 
 
 
-static void drawTxt6x8(uint8_t *fb,uint8_t c,int x0,int y0, uint8_t color){
+static void drawTxt6x8(uint8_t *fb,const uint8_t *table,uint8_t c,int x0,int y0, uint8_t color){
   // extract arguments
     int x;
     int y;
@@ -1460,7 +2115,7 @@ static void drawTxt6x8(uint8_t *fb,uint8_t c,int x0,int y0, uint8_t color){
       c = 32;
     }
       // get char data
-    const uint8_t *chr_data = &currentTextTable[(c - 16) * CH_H];
+    const uint8_t *chr_data = &table[(c - 16) * CH_H];
       // loop over char data
     y = y0;
     for (; y < y0+CH_H; y++) {  
@@ -1550,33 +2205,251 @@ static void fill_rect_4bpp(uint8_t *fb,  int x, int y, int w, int h, uint8_t col
 }
 
 
-static mp_obj_t vtterminal_init(mp_obj_t fb_obj){
+// any format on the pixel grid of a cell, 4bpp goes through fill_rect_4bpp
+static void fill_rect(uint8_t *fb,  int x, int y, int w, int h, uint8_t color){
+    if (fbBpp == 4) {
+        fill_rect_4bpp(fb, x, y, w, h, color);
+        return;
+    }
+    if (x == 0 && w == SC_PIXEL_WIDTH) {
+        // whole rows: a byte holds 1, 2, 4 or 8 pixels of the same value
+        uint8_t fill_byte = (fbBpp == 8) ? color : (fbBpp == 2) ? (color & 0x03) * 0x55 : ((color & 1) ? 0xff : 0x00);
+        memset(fb + y * fbRowBytes, fill_byte, h * fbRowBytes);
+        return;
+    }
+    for (int row = y; row < y + h; row++) {
+        if (fbBpp == 8) {
+            memset(fb + row * fbRowBytes + x, color, w);
+        } else {
+            for (int col = x; col < x + w; col++)
+                setpixel(fb, col, row, color);
+        }
+    }
+}
+
+// init(framebuffer, [format]), format is framebuf.GS4_HMSB (the default),
+// GS8, GS2_HMSB or MONO_HMSB and must match how the display scans fb out
+static mp_obj_t vtterminal_init(size_t n_args, const mp_obj_t *args){
 
     mp_buffer_info_t buf_info;
-    mp_get_buffer_raise(fb_obj, &buf_info, MP_BUFFER_READ);
+    mp_get_buffer_raise(args[0], &buf_info, MP_BUFFER_READ);
+    mp_int_t format = (n_args > 1) ? mp_obj_get_int(args[1]) : FB_GS4_HMSB;
+    uint8_t bpp;
+    switch (format) {
+      case FB_GS4_HMSB:  bpp = 4; break;
+      case FB_GS8:       bpp = 8; break;
+      case FB_GS2_HMSB:  bpp = 2; break;
+      case FB_MONO_HMSB: bpp = 1; break;
+      default:
+        mp_raise_ValueError(MP_ERROR_TEXT("unsupported framebuffer format"));
+    }
+    if (buf_info.len < (size_t)SC_PIXEL_WIDTH * SC_PIXEL_HEIGHT * bpp / 8)
+        mp_raise_ValueError(MP_ERROR_TEXT("framebuffer too small"));
+    // stop the timer from before a soft reset first, it would draw into the
+    // old framebuffer, and a flush it scheduled was dropped with the
+    // scheduler queue, so its flag would block every later frame
+    cancel_repeating_timer(&frame_timer);
+    renderScheduled = false;
+    needRender = false;
+    cursorToggle = false;
     fb=(uint8_t *)buf_info.buf;
+    fbSize = buf_info.len;
+    if (format != fbFormat) {
+        // cached cells were rendered for the old format
+        memset(glyphKey, 0, sizeof(glyphKey));
+        fbFormat = format;
+        fbBpp = bpp;
+        fbRowBytes = SC_PIXEL_WIDTH * bpp / 8;
+        fbLineBytes = fbRowBytes * CH_H;
+    }
+
+    // after a soft reset the heap blocks below are gone, forget them
+    screen = screen0;
+    attrib = attrib0;
+    colors = colors0;
+    con = shownCon = 0;
+    nCons = 1;
+    offscreen = false;
+    for (uint8_t i = 0; i < VT_MAX_CONSOLES; i++) {
+        MP_STATE_VM(vtterminal_consoles)[i] = MP_OBJ_NULL;
+        MP_STATE_VM(vtterminal_altCells)[i] = NULL;
+    }
+    MP_STATE_VM(vtterminal_altFb) = NULL;
+    altFbCon = -1;
+    hist = NULL;
+    histSize = 0;
+    historyClear();
+    clearParams(NONE);
+    utf8Need = 0;
 
-    currentTextTable=G0TABLE;
     resetToInitialState();
     setCursorToHome();
+    sc_render();
 
     //init the timer and callback
-    add_repeating_timer_ms(250, dispCursor, NULL, &cursor_timer);
+    add_repeating_timer_ms(VT_FRAME_MS, frameTick, NULL, &frame_timer);
     return mp_const_true;
 }
 
-static MP_DEFINE_CONST_FUN_OBJ_1(vt_init_obj, vtterminal_init);
+static MP_DEFINE_CONST_FUN_OBJ_VAR_BETWEEN(vt_init_obj, 1, 2, vtterminal_init);
 
 
 
+// attach the scrollback store, any writable buffer (None detaches it)
+static mp_obj_t vt_scrollback(mp_obj_t buf_obj){
+    uint8_t prev = con;
+    selectConsole(shownCon);
+    setViewOffset(0);
+    selectConsole(prev);
+    historyClear();
+    if (buf_obj == mp_const_none) {
+        hist = NULL;
+        histSize = 0;
+        return mp_const_none;
+    }
+    mp_buffer_info_t buf_info;
+    mp_get_buffer_raise(buf_obj, &buf_info, MP_BUFFER_RW);
+    if (buf_info.len < HIST_REC_MAX * 2)
+        mp_raise_ValueError(MP_ERROR_TEXT("scrollback buffer too small"));
+    hist = (uint8_t *)buf_info.buf;
+    histSize = buf_info.len;
+    return mp_const_none;
+}
+static MP_DEFINE_CONST_FUN_OBJ_1(vt_scrollback_obj, vt_scrollback);
+
+static void setViewOffset(int32_t off) {
+    if (off < 0) off = 0;
+    if (off > (int32_t)histLines) off = histLines;
+    if ((uint32_t)off != viewOffset) {
+        if (viewOffset == 0) {
+            viewTop = M_TOP;
+            if (isShowCursor) {
+                isShowCursor = false;
+                markDirty(p_XP, p_YP);
+            }
+        }
+        if (off == 0) {
+            // back to the live screen: redraw what the view covered
+            applyPendingScroll();
+            for (uint16_t y = viewTop; y < SC_H; y++)
+                markLineDirty(y);
+        }
+        viewOffset = off;
+        viewDirty = (off != 0);
+        needRender = true;
+    }
+}
+
+// move the view n lines back into the history (forward if negative),
+// returns how many lines it is scrolled back, 0 is the live screen
+static mp_obj_t vt_scrollView(mp_obj_t lines_obj){
+    // the history belongs to console 0
+    if (shownCon == 0) {
+        uint8_t prev = con;
+        selectConsole(shownCon);
+        setViewOffset((int32_t)viewOffset + mp_obj_get_int(lines_obj));
+        selectConsole(prev);
+    }
+    return mp_obj_new_int(viewOffset);
+}
+static MP_DEFINE_CONST_FUN_OBJ_1(vt_scrollView_obj, vt_scrollView);
+
+// add a console whose cells live in buf (CONSOLE_BYTES), returns its number
+static mp_obj_t vt_openConsole(mp_obj_t buf_obj){
+    mp_buffer_info_t buf_info;
+    mp_get_buffer_raise(buf_obj, &buf_info, MP_BUFFER_RW);
+    if (buf_info.len < CELL_BYTES)
+        mp_raise_ValueError(MP_ERROR_TEXT("console buffer too small"));
+    if ((uintptr_t)buf_info.buf & 1)
+        mp_raise_ValueError(MP_ERROR_TEXT("console buffer not aligned"));
+    if (nCons >= VT_MAX_CONSOLES)
+        mp_raise_ValueError(MP_ERROR_TEXT("too many consoles"));
+    uint8_t n = nCons++;
+    MP_STATE_VM(vtterminal_consoles)[n] = buf_obj;
+    uint8_t *cells = (uint8_t *)buf_info.buf;
+    cons[n].screen = cells;
+    cons[n].attrib = cells + SCSIZE;
+    cons[n].colors = (uint16_t *)(cells + 2 * SCSIZE);
+    uint8_t prev = con;
+    selectConsole(n);
+    clearParams(NONE);
+    utf8Need = 0;
+    canShowCursor = true;
+    initCursorAndAttribute();
+    setCursorToHome();
+    eraseInDisplay(2);
+    selectConsole(prev);
+    return MP_OBJ_NEW_SMALL_INT(n);
+}
+static MP_DEFINE_CONST_FUN_OBJ_1(vt_openConsole_obj, vt_openConsole);
+
+static uint8_t consoleArg(mp_obj_t n_obj) {
+    mp_int_t n = mp_obj_get_int(n_obj);
+    if (n < 0 || n >= nCons)
+        mp_raise_ValueError(MP_ERROR_TEXT("no such console"));
+    return n;
+}
+
+// send the following output to console n, returns the previous one
+static mp_obj_t vt_selectConsole(mp_obj_t n_obj){
+    uint8_t prev = con;
+    selectConsole(consoleArg(n_obj));
+    return MP_OBJ_NEW_SMALL_INT(prev);
+}
+static MP_DEFINE_CONST_FUN_OBJ_1(vt_selectConsole_obj, vt_selectConsole);
+
+// display console n, returns the previously shown one
+static mp_obj_t vt_showConsole(mp_obj_t n_obj){
+    uint8_t prev = shownCon;
+    showConsole(consoleArg(n_obj));
+    return MP_OBJ_NEW_SMALL_INT(prev);
+}
+static MP_DEFINE_CONST_FUN_OBJ_1(vt_showConsole_obj, vt_showConsole);
+
+// (hits, misses) of the rendered cell cache, reset=True clears them
+static mp_obj_t vt_cacheStats(size_t n_args, const mp_obj_t *args){
+    mp_obj_t stats[2] = { mp_obj_new_int_from_uint(glyphHits), mp_obj_new_int_from_uint(glyphMisses) };
+    if (n_args > 0 && mp_obj_is_true(args[0]))
+        glyphHits = glyphMisses = 0;
+    return mp_obj_new_tuple(2, stats);
+}
+static MP_DEFINE_CONST_FUN_OBJ_VAR_BETWEEN(vt_cacheStats_obj, 0, 1, vt_cacheStats);
+
+// move pending replies into buf, returns the number of bytes copied
+static size_t respRead(uint8_t *buf, size_t len) {
+    size_t n = (len < respLen) ? len : respLen;
+    size_t first = VT_RESP_SIZE - respHead;
+    if (first > n) first = n;
+    memcpy(buf, &respBuf[respHead], first);
+    memcpy(buf + first, respBuf, n - first);
+    respHead = (respHead + n) % VT_RESP_SIZE;
+    respLen -= n;
+    return n;
+}
+
 static mp_obj_t vt_read(void){
-    
-    mp_obj_t result = mp_obj_new_str(outputBuf, outputLen);
-    outputLen = 0;
-    return result;
+    char temp[VT_RESP_SIZE];
+    size_t n = respRead((uint8_t *)temp, sizeof(temp));
+    return mp_obj_new_str(temp, n);
 }
 static MP_DEFINE_CONST_FUN_OBJ_0(vt_read_obj, vt_read);
 
+static mp_obj_t vt_readinto(mp_obj_t buf_obj){
+    mp_buffer_info_t buf_info;
+    mp_get_buffer_raise(buf_obj, &buf_info, MP_BUFFER_WRITE);
+    return MP_OBJ_NEW_SMALL_INT(respRead((uint8_t *)buf_info.buf, buf_info.len));
+}
+static MP_DEFINE_CONST_FUN_OBJ_1(vt_readinto_obj, vt_readinto);
+
+// Ctrl+C seen by a background key scanner: raise KeyboardInterrupt in the main
+// thread at its next bytecode, the way the USB serial does, from a timer
+// callback or the other core
+static mp_obj_t vt_interrupt(void){
+    mp_sched_keyboard_interrupt();
+    return mp_const_none;
+}
+static MP_DEFINE_CONST_FUN_OBJ_0(vt_interrupt_obj, vt_interrupt);
+
 
 
 
@@ -1584,7 +2457,18 @@ static const mp_rom_map_elem_t vtterminal_globals_table[] = {
     { MP_ROM_QSTR(MP_QSTR___name__), MP_ROM_QSTR(MP_QSTR_vtterminal) },
     { MP_ROM_QSTR(MP_QSTR_init), MP_ROM_PTR(&vt_init_obj) },
     { MP_ROM_QSTR(MP_QSTR_read), MP_ROM_PTR(&vt_read_obj) },
-    { MP_ROM_QSTR(MP_QSTR_printChar), MP_ROM_PTR(&vt_printChar_obj)}
+    { MP_ROM_QSTR(MP_QSTR_readinto), MP_ROM_PTR(&vt_readinto_obj) },
+    { MP_ROM_QSTR(MP_QSTR_printChar), MP_ROM_PTR(&vt_printChar_obj)},
+    { MP_ROM_QSTR(MP_QSTR_write), MP_ROM_PTR(&vt_write_obj)},
+    { MP_ROM_QSTR(MP_QSTR_flush), MP_ROM_PTR(&vt_flush_obj)},
+    { MP_ROM_QSTR(MP_QSTR_scrollback), MP_ROM_PTR(&vt_scrollback_obj)},
+    { MP_ROM_QSTR(MP_QSTR_scrollView), MP_ROM_PTR(&vt_scrollView_obj)},
+    { MP_ROM_QSTR(MP_QSTR_cacheStats), MP_ROM_PTR(&vt_cacheStats_obj)},
+    { MP_ROM_QSTR(MP_QSTR_openConsole), MP_ROM_PTR(&vt_openConsole_obj)},
+    { MP_ROM_QSTR(MP_QSTR_selectConsole), MP_ROM_PTR(&vt_selectConsole_obj)},
+    { MP_ROM_QSTR(MP_QSTR_showConsole), MP_ROM_PTR(&vt_showConsole_obj)},
+    { MP_ROM_QSTR(MP_QSTR_interrupt), MP_ROM_PTR(&vt_interrupt_obj)},
+    { MP_ROM_QSTR(MP_QSTR_CONSOLE_BYTES), MP_ROM_INT(CELL_BYTES)}
 };
 static MP_DEFINE_CONST_DICT(vtterminal_globals, vtterminal_globals_table);
 